@@ -6,165 +6,1539 @@
 """
 
 from __future__ import with_statement
-from ambient_api.ambientapi import AmbientAPI
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import math
+import queue
+import random
+import re
+import threading
 import time
-import syslog
 import logging
 import weedb
 import weewx.drivers
 import weeutil.weeutil
+import weewx.accum
+import weewx.units
 import weewx.wxformulas
 import tempfile
+import json
+import os
 import os.path
 from os import path
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 DRIVER_NAME = 'ambientweatherapi'
 DRIVER_VERSION = '0.0.18'
+# The device history endpoint returns at most this many records per request
+HISTORY_PAGE_SIZE = 288
+# Minutes between records in the device history
+HISTORY_INTERVAL = 5
+# Observations worked out in the driver rather than by StdWXCalculate
+DERIVED_FIELDS = ('rainRate', 'windrun', 'cloudbase', 'heatindex', 'windchill', 'appTemp', 'humidex', 'maxSolarRad')
+# Finds each device of a /devices payload, and the start of its lastData object
+MAC_ADDRESS_PATTERN = re.compile(r'"macAddress"\s*:\s*"([^"]*)"')
+LAST_DATA_PATTERN = re.compile(r'"lastData"\s*:\s*')
 log = logging.getLogger(__name__)
 
 
+def to_float(value):
+    """Converts a value to a float, leaving None alone."""
+    if value is None:
+        return value
+    return float(value)
+
+
+def interval_rain(last_rain, dailyrainin):
+    """Returns the rain since the previous daily total.
+
+    The daily total resets at midnight, so a total lower than the previous one is all new rain."""
+    if last_rain > dailyrainin:
+        return dailyrainin
+    return dailyrainin - last_rain
+
+
+def make_battery_converter(use_meteobridge):
+    """Returns a function converting the AM API battery status to something weewx likes.
+
+    The Meteobridge flip is decided here once rather than on every value."""
+    low, ok = (0.0, 1.0) if use_meteobridge else (1.0, 0.0)
+
+    def battery_status(value):
+        if value is None:
+            return None
+        return low if value <= 0 else ok
+    return battery_status
+
+
+def make_unit_converter(unit_system):
+    """Returns a function giving the conversion of a weewx observation from US units to unit_system, or None.
+
+    The conversion of each observation name is looked up once, in the same weewx.units
+    tables StdConvert uses, so packets come out as StdConvert would have made them.
+    Names weewx does not know are not converted, so prefixed station fields must be
+    looked up by their unprefixed name."""
+    conversions = {}
+
+    def unit_converter(key):
+        if key not in conversions:
+            from_unit = weewx.units.getStandardUnitType(weewx.US, key)[0]
+            to_unit = weewx.units.getStandardUnitType(unit_system, key)[0]
+            conversions[key] = None
+            if from_unit is not None and to_unit is not None and from_unit != to_unit:
+                conversions[key] = weewx.units.conversionDict[from_unit][to_unit]
+        return conversions[key]
+    return unit_converter
+
+
+def with_unit_conversion(convert, to_unit):
+    """Returns convert followed by the unit conversion to_unit, leaving None alone."""
+    def converted(value):
+        value = convert(value)
+        return to_unit(value) if value is not None else None
+    return converted
+
+
+class RealtimeSubscription(object):
+    """Subscription to the Ambient realtime API.
+
+    The realtime API is a Socket.IO service that pushes a data event each time a
+    station uploads.  Events arrive on the Socket.IO client's thread and are queued
+    as (MAC, data) for the driver to pick up.  Needs the optional python-socketio package."""
+
+    __slots__ = ('url', 'api_key', 'app_key', 'timeout', 'events', 'first_mac', 'client')
+
+    def __init__(self, url, api_key, app_key, timeout=30):
+        self.url = url
+        self.api_key = api_key
+        self.app_key = app_key
+        self.timeout = timeout
+        self.events = queue.Queue()
+        self.first_mac = None
+        self.client = None
+
+    def connect(self):
+        """Connects and subscribes, raising an exception if that is not possible."""
+        import socketio
+
+        self.client = socketio.Client(reconnection=True)
+        self.client.on('connect', self.on_connect)
+        self.client.on('subscribed', self.on_subscribed)
+        self.client.on('data', self.on_data)
+        self.client.on('disconnect', self.on_disconnect)
+        self.client.connect('%s/?api=1&applicationKey=%s' % (self.url, self.app_key),
+                            transports=['websocket'], wait_timeout=self.timeout)
+
+    def on_connect(self):
+        """Subscribes, again after every reconnect as the server forgets the subscription with the connection."""
+        client = self.client
+        if client is not None:
+            client.emit('subscribe', {'apiKeys': [self.api_key]})
+
+    def on_subscribed(self, message):
+        """Queues the last data of every device the subscription covers."""
+        devices = message.get('devices', [])
+        log.info("Realtime API subscribed to %d device(s)", len(devices))
+        for device in devices:
+            if self.first_mac is None:
+                self.first_mac = device.get('macAddress')
+            if device.get('lastData'):
+                self.events.put((device.get('macAddress'), device['lastData']))
+
+    def on_data(self, data):
+        """Queues a data event."""
+        self.events.put((data.get('macAddress'), data))
+
+    def on_disconnect(self):
+        log.info("Realtime API disconnected")
+
+    def get(self, timeout):
+        """Returns the next (MAC, data), raising queue.Empty if none arrives within timeout seconds."""
+        return self.events.get(timeout=timeout)
+
+    def close(self):
+        """Disconnects from the realtime API."""
+        if self.client is not None:
+            try:
+                self.client.disconnect()
+            except Exception as e:
+                log.debug("Error disconnecting from the realtime API: %s", e)
+            self.client = None
+
+
+class RainStateStore(object):
+    """Previous daily rain totals of every station, kept in memory.
+
+    The totals are persisted to a small JSON file whose name does not depend on the
+    driver version.  The file is only written when a total has changed, at most every
+    flush_interval seconds, and is replaced atomically (write a temp file, fsync,
+    rename) so a crash leaves either the old or the new state behind."""
+
+    __slots__ = ('filepath', 'flush_interval', 'clock', 'values', 'dirty', 'last_flush')
+
+    def __init__(self, filepath, flush_interval=0, clock=time.monotonic):
+        self.filepath = filepath
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.values = {}
+        self.dirty = False
+        self.last_flush = clock()
+        self.load()
+
+    def load(self):
+        """Reads the state file, starting empty if it is missing or unreadable."""
+        try:
+            with open(self.filepath, 'r') as state_file:
+                self.values = dict((key, float(value)) for key, value in json.load(state_file)['rain'].items())
+        except (IOError, OSError):
+            log.debug('No state file found at: %s', self.filepath)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            log.error('Ignoring unreadable state file %s: %s', self.filepath, e)
+
+    def get(self, key):
+        """Returns the recorded daily rain total of a station, or None."""
+        return self.values.get(key)
+
+    def set(self, key, value):
+        """Records the daily rain total of a station, flushing if it changed and a flush is due."""
+        if self.values.get(key) != value:
+            self.values[key] = value
+            self.dirty = True
+        if self.dirty and self.clock() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Atomically writes the state file if anything changed since the last write."""
+        if not self.dirty:
+            return
+        tmppath = self.filepath + '.tmp'
+        with open(tmppath, 'w') as state_file:
+            json.dump({'rain': self.values}, state_file)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(tmppath, self.filepath)
+        self.dirty = False
+        self.last_flush = self.clock()
+
+
+class StageTimer(object):
+    """Reusable context manager timing one stage of the driver.
+
+    DriverStats keeps one per stage, so timing a block does not allocate a new context
+    manager each time.  Each thread stacks its own starts, so the accounts' fetches
+    timing the same stage at once on the poll threads each get their own timing."""
+
+    __slots__ = ('stats', 'stage', 'local')
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+        self.local = threading.local()
+
+    def __enter__(self):
+        try:
+            starts = self.local.starts
+        except AttributeError:
+            starts = self.local.starts = []
+        starts.append(time.perf_counter())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.record(self.stage, time.perf_counter() - self.local.starts.pop())
+        return False
+
+
+class DriverStats(object):
+    """Per-stage timings and counters of the driver.
+
+    Each stage keeps its most recent timings in a fixed-size buffer for the rolling
+    quantiles, plus running totals.  A snapshot can be written as JSON or in the
+    Prometheus text format (for the node_exporter textfile collector)."""
+
+    __slots__ = ('window', 'timings', 'totals', 'timers', 'counters', 'gauges', 'lock')
+
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, window=256):
+        self.window = window
+        self.timings = {}
+        self.totals = {}
+        self.timers = {}
+        self.counters = collections.Counter()
+        self.gauges = {}
+        # Timings are recorded from the poll threads as well as weewx's
+        self.lock = threading.Lock()
+
+    def timer(self, stage):
+        """Returns the context manager timing the enclosed block as the named stage."""
+        timer = self.timers.get(stage)
+        if timer is None:
+            timer = self.timers[stage] = StageTimer(self, stage)
+        return timer
+
+    def record(self, stage, seconds):
+        """Records one timing of a stage."""
+        with self.lock:
+            if stage not in self.timings:
+                self.timings[stage] = collections.deque(maxlen=self.window)
+                self.totals[stage] = [0, 0.0]
+            self.timings[stage].append(seconds)
+            totals = self.totals[stage]
+            totals[0] += 1
+            totals[1] += seconds
+
+    def increment(self, counter, amount=1):
+        """Adds to a counter."""
+        self.counters[counter] += amount
+
+    def gauge(self, name, value):
+        """Sets a gauge."""
+        self.gauges[name] = value
+
+    def snapshot(self):
+        """Returns the stats as a dict."""
+        stages = {}
+        with self.lock:
+            timings_by_stage = [(stage, sorted(timings), tuple(self.totals[stage]))
+                                for stage, timings in self.timings.items()]
+        for stage, ordered, (count, total) in timings_by_stage:
+            stages[stage] = {
+                'count': count,
+                'sum': total,
+                'max': ordered[-1],
+                'quantiles': dict((str(q), ordered[min(len(ordered) - 1, int(q * len(ordered)))])
+                                  for q in self.QUANTILES),
+            }
+        return {'stages': stages, 'counters': dict(self.counters), 'gauges': dict(self.gauges)}
+
+    def prometheus(self):
+        """Returns the stats in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = ['# TYPE %s_stage_seconds summary' % DRIVER_NAME]
+        for stage, stats in sorted(snapshot['stages'].items()):
+            for q, value in sorted(stats['quantiles'].items()):
+                lines.append('%s_stage_seconds{stage="%s",quantile="%s"} %.6f' % (DRIVER_NAME, stage, q, value))
+            lines.append('%s_stage_seconds_sum{stage="%s"} %.6f' % (DRIVER_NAME, stage, stats['sum']))
+            lines.append('%s_stage_seconds_count{stage="%s"} %d' % (DRIVER_NAME, stage, stats['count']))
+        lines.append('# TYPE %s_events_total counter' % DRIVER_NAME)
+        for counter, value in sorted(snapshot['counters'].items()):
+            lines.append('%s_events_total{event="%s"} %d' % (DRIVER_NAME, counter, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append('# TYPE %s_%s gauge' % (DRIVER_NAME, name))
+            lines.append('%s_%s %.3f' % (DRIVER_NAME, name, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filepath, stats_format='json'):
+        """Writes a snapshot to a file, replacing it atomically so readers never see a partial file."""
+        if stats_format == 'prometheus':
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+        tmppath = filepath + '.tmp'
+        with open(tmppath, 'w') as stats_file:
+            stats_file.write(content)
+        os.replace(tmppath, filepath)
+
+
+class OfflineQueue(object):
+    """Bounded on-disk backlog of observations missed during API outages.
+
+    While the API cannot be reached the driver records when each outage started.
+    On recovery the missed observations are fetched from the device history and
+    queued, and genArchiveRecords() or genStartupRecords() drains them in timestamp
+    order, so weewx can archive them.  The file is append-only JSON lines and is
+    rewritten when it is drained, when an outage ends with nothing to queue, or when
+    it holds more than max_records observations, in which case the oldest are dropped."""
+
+    __slots__ = ('filepath', 'max_records', 'outages', 'records', 'rain_before')
+
+    def __init__(self, filepath, max_records=2016):
+        self.filepath = filepath
+        self.max_records = max_records
+        # MAC -> (dateutc the outage started after, daily rain total at that time)
+        self.outages = {}
+        # MAC -> {dateutc: data}
+        self.records = {}
+        # MAC -> daily rain total before the first queued observation
+        self.rain_before = {}
+        self.load()
+
+    def load(self):
+        """Replays the queue file, starting empty if it is missing."""
+        try:
+            with open(self.filepath, 'r') as queue_file:
+                for line in queue_file:
+                    try:
+                        self.apply(json.loads(line))
+                    except (ValueError, KeyError, TypeError) as e:
+                        log.error('Skipping unreadable line in queue file %s: %s', self.filepath, e)
+        except (IOError, OSError):
+            log.debug('No queue file found at: %s', self.filepath)
+
+    def apply(self, entry):
+        """Applies one queue file entry to the in-memory state."""
+        mac = entry['mac']
+        if 'outage' in entry:
+            self.outages[mac] = (entry['outage'], entry.get('rain'))
+        elif 'queued' in entry:
+            outage = self.outages.pop(mac, None)
+            if outage is not None and mac not in self.rain_before:
+                self.rain_before[mac] = outage[1]
+        elif 'data' in entry:
+            self.records.setdefault(mac, {})[entry['data']['dateutc']] = entry['data']
+
+    def append(self, entries):
+        """Applies entries and appends them to the queue file."""
+        for entry in entries:
+            self.apply(entry)
+        with open(self.filepath, 'a') as queue_file:
+            for entry in entries:
+                queue_file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            queue_file.flush()
+            os.fsync(queue_file.fileno())
+        if sum(len(records) for records in self.records.values()) > self.max_records:
+            self.trim()
+
+    def mark_outage(self, mac, dateutc, rain):
+        """Records that the API could not be reached after the observation at dateutc."""
+        if mac not in self.outages:
+            log.info('Recording outage of station %s after %s', mac, dateutc)
+            self.append([{'mac': mac, 'outage': dateutc, 'rain': rain}])
+
+    def end_outage(self, mac, records):
+        """Queues the observations missed during the outage of a station, and closes the outage.
+
+        With nothing to queue the file is compacted rather than appended to, so short
+        outages do not grow it."""
+        if not records:
+            if self.outages.pop(mac, None) is not None:
+                self.rewrite()
+            return
+        entries = [{'mac': mac, 'data': data} for data in records]
+        entries.append({'mac': mac, 'queued': len(records)})
+        self.append(entries)
+
+    def pending(self, mac):
+        """Returns the number of queued observations of a station."""
+        return len(self.records.get(mac, {}))
+
+    def drain(self, mac):
+        """Removes and returns the queued observations of a station, oldest first and without duplicates.
+
+        Returns (observations, daily rain total before the first of them)."""
+        records = self.records.pop(mac, {})
+        rain = self.rain_before.pop(mac, None)
+        if records:
+            self.rewrite()
+        return [records[dateutc] for dateutc in sorted(records)], rain
+
+    def trim(self):
+        """Drops the oldest observations until no more than max_records are queued."""
+        queued = sorted((dateutc, mac) for mac, records in self.records.items() for dateutc in records)
+        for dateutc, mac in queued[:len(queued) - self.max_records]:
+            del self.records[mac][dateutc]
+        log.info('Offline queue full, dropped the %d oldest observations', max(0, len(queued) - self.max_records))
+        self.rewrite()
+
+    def rewrite(self):
+        """Atomically rewrites the queue file from the in-memory state."""
+        tmppath = self.filepath + '.tmp'
+        with open(tmppath, 'w') as queue_file:
+            for mac, records in self.records.items():
+                if not records:
+                    continue
+                # The closed outage carries the rain before the queued observations, as load() expects
+                queue_file.write(json.dumps({'mac': mac, 'outage': min(records),
+                                             'rain': self.rain_before.get(mac)}) + '\n')
+                for dateutc in sorted(records):
+                    queue_file.write(json.dumps({'mac': mac, 'data': records[dateutc]}, separators=(',', ':')) + '\n')
+                queue_file.write(json.dumps({'mac': mac, 'queued': len(records)}) + '\n')
+            # Outages still open go last, so no queued line closes them
+            for mac, (dateutc, rain) in self.outages.items():
+                queue_file.write(json.dumps({'mac': mac, 'outage': dateutc, 'rain': rain}) + '\n')
+            queue_file.flush()
+            os.fsync(queue_file.fileno())
+        os.replace(tmppath, self.filepath)
+
+
+class DerivedObservations(object):
+    """Adds the observations StdWXCalculate would otherwise work out to the packets of one station.
+
+    Keeps a little rolling state: the rain of the last rain_period seconds with its
+    running total for rainRate, and the time of the previous packet for windrun.  The
+    station's altitude and location are converted once, here.  Packets are in unit_system
+    and the formulas are picked for it the way weewx's StdWXCalculate picks them.
+    Fields already in a packet, or whose inputs are missing, are left alone."""
+
+    __slots__ = ('fields', 'key', 'altitude_ft', 'altitude_m', 'latitude', 'longitude', 'rain_period', 'max_gap',
+                 'unit_system', 'windrun_factor', 'rain_events', 'rain_sum', 'last_ts')
+
+    def __init__(self, prefix='', fields=DERIVED_FIELDS, altitude_ft=None, latitude=None, longitude=None,
+                 rain_period=900, max_gap=300, unit_system=weewx.US):
+        self.fields = frozenset(fields)
+        inputs = ('outTemp', 'outHumidity', 'windSpeed', 'rain')
+        self.key = dict((name, prefix + name) for name in DERIVED_FIELDS + inputs)
+        self.altitude_ft = altitude_ft
+        self.altitude_m = altitude_ft * 0.3048 if altitude_ft is not None else None
+        self.latitude = latitude
+        self.longitude = longitude
+        self.rain_period = rain_period
+        self.max_gap = max_gap
+        self.unit_system = unit_system
+        # Wind run per unit of speed and second: miles from mph, km from km/h or from m/s
+        self.windrun_factor = 1 / 1000.0 if unit_system == weewx.METRICWX else 1 / 3600.0
+        # (dateTime, rain) of the packets with rain in the last rain_period
+        self.rain_events = collections.deque()
+        self.rain_sum = 0.0
+        self.last_ts = None
+
+    def rain_rate(self, ts, rain):
+        """Adds the rain of a packet to the window, returning the rain rate over the window."""
+        if rain:
+            self.rain_events.append((ts, rain))
+            self.rain_sum += rain
+        while self.rain_events and self.rain_events[0][0] <= ts - self.rain_period:
+            self.rain_sum -= self.rain_events.popleft()[1]
+        if not self.rain_events:
+            # Start again from an exact zero rather than carry rounding errors along
+            self.rain_sum = 0.0
+        return 3600.0 * self.rain_sum / self.rain_period
+
+    def add(self, _packet, interval=None):
+        """Adds the derived observations to a packet.  interval is in minutes, as in an archive record."""
+        key = self.key
+        fields = self.fields
+        ts = _packet['dateTime']
+        elapsed = interval * 60 if interval is not None else None
+        if elapsed is None and self.last_ts is not None and 0 < ts - self.last_ts <= self.max_gap:
+            elapsed = ts - self.last_ts
+        self.last_ts = ts
+        # Written straight into the packet, setdefault leaves a field the station sent alone
+        setdefault = _packet.setdefault
+        if 'rainRate' in fields:
+            setdefault(key['rainRate'], self.rain_rate(ts, _packet.get(key['rain'])))
+        temp = _packet.get(key['outTemp'])
+        humidity = _packet.get(key['outHumidity'])
+        wind = _packet.get(key['windSpeed'])
+        if 'windrun' in fields and wind is not None and elapsed is not None:
+            setdefault(key['windrun'], wind * elapsed * self.windrun_factor)
+        if self.unit_system == weewx.US:
+            if temp is not None and humidity is not None:
+                if 'heatindex' in fields:
+                    setdefault(key['heatindex'], weewx.wxformulas.heatindexF(temp, humidity))
+                if 'humidex' in fields:
+                    setdefault(key['humidex'], weewx.wxformulas.humidexF(temp, humidity))
+                if 'cloudbase' in fields and self.altitude_ft is not None:
+                    setdefault(key['cloudbase'], weewx.wxformulas.cloudbase_US(temp, humidity, self.altitude_ft))
+                if 'appTemp' in fields and wind is not None:
+                    setdefault(key['appTemp'], weewx.wxformulas.apptempF(temp, humidity, wind))
+            if 'windchill' in fields and temp is not None and wind is not None:
+                setdefault(key['windchill'], weewx.wxformulas.windchillF(temp, wind))
+        else:
+            if temp is not None and humidity is not None:
+                if 'heatindex' in fields:
+                    setdefault(key['heatindex'], weewx.wxformulas.heatindexC(temp, humidity))
+                if 'humidex' in fields:
+                    setdefault(key['humidex'], weewx.wxformulas.humidexC(temp, humidity))
+                if 'cloudbase' in fields and self.altitude_m is not None:
+                    setdefault(key['cloudbase'], weewx.wxformulas.cloudbase_Metric(temp, humidity, self.altitude_m))
+                if 'appTemp' in fields and wind is not None:
+                    # The metric formula takes the wind in m/s
+                    wind_mps = wind if self.unit_system == weewx.METRICWX else wind / 3.6
+                    setdefault(key['appTemp'], weewx.wxformulas.apptempC(temp, humidity, wind_mps))
+            if 'windchill' in fields and temp is not None and wind is not None:
+                if self.unit_system == weewx.METRICWX:
+                    setdefault(key['windchill'], weewx.wxformulas.windchillMetricWX(temp, wind))
+                else:
+                    setdefault(key['windchill'], weewx.wxformulas.windchillMetric(temp, wind))
+        if 'maxSolarRad' in fields and self.latitude is not None and self.longitude is not None \
+                and self.altitude_m is not None:
+            setdefault(key['maxSolarRad'],
+                       weewx.wxformulas.solar_rad_RS(self.latitude, self.longitude, self.altitude_m, ts))
+        return _packet
+
+
+class Account(object):
+    """An Ambient account the driver polls: its keys, timeout, stations and API client.
+
+    The first account is the one configured at the top of the driver section, its
+    first station keeps the plain weewx names.  fetch is the account's poll in flight,
+    if any, so a slow account is left to finish rather than asked again.  A request
+    waits at most max_wait seconds for its rate limiter slot, on top of its timeout."""
+
+    __slots__ = ('name', 'api_key', 'app_key', 'timeout', 'max_wait', 'stations', 'station_macs',
+                 'use_station_mac', 'rate_limiter', 'api', 'http', 'fetch', 'cached_macs')
+
+    def __init__(self, name, api_key, app_key, timeout, stations, station_macs, rate_limiter=None):
+        self.name = name
+        self.api_key = api_key
+        self.app_key = app_key
+        self.timeout = timeout
+        self.max_wait = timeout / 2.0 if rate_limiter is not None else 0.0
+        self.stations = stations
+        self.station_macs = frozenset(station_macs)
+        self.use_station_mac = bool(station_macs)
+        self.rate_limiter = rate_limiter
+        self.api = None
+        self.http = None
+        self.fetch = None
+        # MACs of the stations the response cache can answer this account's polls for
+        self.cached_macs = []
+
+
+class Station(object):
+    """A station served by the driver.
+
+    Packets from every station but the first have their observation names prefixed,
+    so several stations can share one weewx loop packet stream."""
+
+    __slots__ = ('mac', 'prefix', 'plan_by_field', 'derived', 'rain_key')
+
+    def __init__(self, mac, prefix, plan_by_field, derived=None, rain_key=None):
+        self.mac = mac
+        self.prefix = prefix
+        self.plan_by_field = plan_by_field
+        self.derived = derived
+        # Packet key of the interval rain, None if it is not sent
+        self.rain_key = rain_key
+
+
+def get_schema_columns(config_dict=None):
+    """Returns the set of archive column names of the schema weewx is configured with.
+
+    The schema is looked up through the StdArchive data binding.  When it cannot be
+    found, the schema shipped with this driver (user.awschema) is used."""
+    schema = None
+    if config_dict is not None:
+        try:
+            binding = config_dict.get('StdArchive', {}).get('data_binding', 'wx_binding')
+            schema_name = config_dict['DataBindings'][binding]['schema']
+            schema = weeutil.weeutil.get_object(schema_name)
+            log.info('Using schema: %s', schema_name)
+        except Exception as e:
+            log.info('Could not load the configured schema, using user.awschema: %s', e)
+    if schema is None:
+        import user.awschema
+        schema = user.awschema.table
+    if isinstance(schema, dict):
+        schema = schema['table']
+    return set(column for column, column_type in schema)
+
+
+def get_altitude_ft(altitude):
+    """Converts an altitude as weewx.conf gives it ("700, foot", or a value and unit list) to feet."""
+    if altitude is None:
+        return None
+    if isinstance(altitude, str):
+        altitude = altitude.split(',')
+    if not isinstance(altitude, (list, tuple)):
+        altitude = [altitude]
+    unit = altitude[1].strip() if len(altitude) > 1 else 'foot'
+    return weewx.units.convert((float(altitude[0]), unit, 'group_altitude'), 'foot')[0]
+
+
+def register_accumulators(prefix, keys):
+    """Gives the prefixed names of keys the accumulator options weewx has for the plain names.
+
+    weewx averages a field over the archive period unless [Accumulator] says otherwise, so a
+    second station's rain and windrun would be averaged rather than summed.  Only the scalar
+    extractors (sum and last) are copied.  The entries go in with weewx's own defaults, so an
+    [Accumulator] section in weewx.conf still overrides them.  Returns the names registered."""
+    defaults = weewx.accum.accum_dict.maps[-1]
+    registered = []
+    for key in keys:
+        options = weewx.accum.accum_dict.get(key)
+        if options is None or options.get('extractor') not in ('sum', 'last') or prefix + key in defaults:
+            continue
+        defaults[prefix + key] = dict(options)
+        registered.append(prefix + key)
+    return registered
+
+
 def loader(config_dict, engine):
-    station = AmbientWeatherAPI(**config_dict[DRIVER_NAME])
+    # The station location feeds the derived observations, the driver section can override it
+    stn_dict = dict((key, value) for key, value in config_dict.get('Station', {}).items()
+                    if key in ('altitude', 'latitude', 'longitude'))
+    stn_dict.update(config_dict[DRIVER_NAME])
+    # Late packets of a slow account are still sent if they fall in weewx's current archive period
+    stn_dict['archive_period'] = config_dict.get('StdArchive', {}).get('archive_interval', 300)
+    station = AmbientWeatherAPI(schema_columns=get_schema_columns(config_dict), **stn_dict)
     return station
 
 
+class RateLimited(Exception):
+    """Raised instead of making a request that would have to wait too long for the rate limiter."""
+
+    def __init__(self, wait):
+        super(RateLimited, self).__init__('Rate limited, the next request slot is in %.1f seconds' % wait)
+        self.wait = wait
+
+
+class SharedRateLimiter(object):
+    """Token bucket rate limiter shared by every driver on the host through a locked file.
+
+    Each bucket is kept as the theoretical arrival time (GCRA) of its next request,
+    which is the same as a token bucket refilled at rate requests per second and
+    holding burst tokens.  A request takes its slot in every bucket it uses while
+    the file is locked, and then waits for the slot outside the lock, so processes
+    are served in the order they asked.  penalize() holds a bucket off after a 429.
+    The clock is wall time by default, as the file is shared between processes."""
+
+    __slots__ = ('filepath', 'buckets', 'burst', 'clock', 'sleep')
+
+    def __init__(self, filepath, buckets, burst=1, clock=time.time, sleep=time.sleep):
+        self.filepath = filepath
+        # bucket name -> requests per second
+        self.buckets = dict(buckets)
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+
+    @contextlib.contextmanager
+    def locked_state(self):
+        """Yields the shared state dict with the file locked, writing it back afterwards."""
+        with open(self.filepath, 'a+') as state_file:
+            if fcntl is not None:
+                fcntl.flock(state_file.fileno(), fcntl.LOCK_EX)
+            try:
+                state_file.seek(0)
+                try:
+                    state = json.loads(state_file.read() or '{}')
+                except ValueError:
+                    state = {}
+                yield state
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps(state))
+                state_file.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(state_file.fileno(), fcntl.LOCK_UN)
+
+    def reserve(self, max_wait=None):
+        """Takes the next request slot, returning the seconds until it.
+
+        Returns None, without taking a slot, if that would be more than max_wait seconds away."""
+        with self.locked_state() as state:
+            now = self.clock()
+            slot = now
+            for name, rate in self.buckets.items():
+                bucket = state.get(name, {})
+                # The bucket allows burst requests ahead of its arrival time
+                slot = max(slot, bucket.get('tat', now) - (self.burst - 1) / rate, bucket.get('blocked', now))
+            if max_wait is not None and slot - now > max_wait:
+                return None
+            for name, rate in self.buckets.items():
+                bucket = state.setdefault(name, {})
+                bucket['tat'] = max(bucket.get('tat', now), slot) + 1.0 / rate
+                if bucket.get('blocked', now) <= now:
+                    bucket.pop('blocked', None)
+        return slot - now
+
+    def acquire(self, max_wait=None):
+        """Waits for the next request slot, raising RateLimited if it is more than max_wait seconds away."""
+        wait = self.reserve(max_wait)
+        if wait is None:
+            raise RateLimited(self.wait_time())
+        if wait > 0:
+            self.sleep(wait)
+
+    def wait_time(self):
+        """Returns the seconds until a request could be made, without taking a slot."""
+        with self.locked_state() as state:
+            now = self.clock()
+            slot = now
+            for name, rate in self.buckets.items():
+                bucket = state.get(name, {})
+                slot = max(slot, bucket.get('tat', now) - (self.burst - 1) / rate, bucket.get('blocked', now))
+        return slot - now
+
+    def penalize(self, retry_after):
+        """Holds every bucket off for retry_after seconds, after the API answered 429."""
+        with self.locked_state() as state:
+            until = self.clock() + retry_after
+            for name in self.buckets:
+                bucket = state.setdefault(name, {})
+                bucket['blocked'] = max(bucket.get('blocked', until), until)
+
+
+def rate_limit_bucket(kind, key):
+    """Returns the shared bucket name of an API or application key, without writing the key itself."""
+    return '%s:%s' % (kind, hashlib.sha256((key or '').encode('utf-8')).hexdigest()[:16])
+
+
+class AmbientHTTPClient(object):
+    """Pooled HTTP client handed to AmbientAPI as its http_client.
+
+    AmbientAPI calls client.get(url, params, verify=True) the same way it would
+    call requests.get.  This forwards those calls to a single requests.Session
+    so the TLS connection and DNS lookup are reused from one poll to the next.
+    With a rate limiter each request first waits for its slot, up to max_wait seconds.
+
+    With revalidate set the last few responses carrying an ETag or Last-Modified are
+    kept, and asking for the same URL again sends a conditional request.  A 304 Not
+    Modified answer hands back the kept response, so callers never see the 304.
+
+    requests, most of the driver's import time, is only imported once a client is
+    made.  connection_errors holds its exceptions for a connection that failed or
+    timed out, for callers to catch without importing it themselves."""
+
+    __slots__ = ('timeout', 'rate_limiter', 'max_wait', 'revalidate', 'max_responses', 'responses', 'session',
+                 'last_status', 'last_headers', 'connection_errors')
+
+    def __init__(self, timeout=30, rate_limiter=None, max_wait=None, revalidate=False, max_responses=4):
+        import requests
+        import requests.adapters
+
+        self.connection_errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.max_wait = max_wait
+        self.revalidate = revalidate
+        self.max_responses = max_responses
+        self.responses = collections.OrderedDict()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.last_status = None
+        self.last_headers = {}
+
+    def get(self, url, params=None, **kwargs):
+        """Performs a GET on the pooled session, remembering the status and headers."""
+        kwargs.setdefault('timeout', self.timeout)
+        if self.rate_limiter is not None:
+            try:
+                self.rate_limiter.acquire(self.max_wait)
+            except RateLimited as e:
+                # Reported like a 429, so the scheduler backs off until the slot
+                self.last_status = 429
+                self.last_headers = {'Retry-After': '%.1f' % e.wait}
+                raise
+        key = cached = None
+        if self.revalidate:
+            key = (url, tuple(sorted((params or {}).items())))
+            cached = self.responses.get(key)
+            if cached is not None:
+                kwargs['headers'] = self.conditional_headers(cached, kwargs.get('headers'))
+        res = self.session.get(url, params=params, **kwargs)
+        self.last_status = res.status_code
+        self.last_headers = res.headers
+        if res.status_code == 429 and self.rate_limiter is not None:
+            try:
+                retry_after = float(res.headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                retry_after = 1.0
+            self.rate_limiter.penalize(retry_after)
+        if key is not None:
+            if res.status_code == 304 and cached is not None:
+                self.responses.move_to_end(key)
+                return cached
+            if res.status_code == 200 and ('ETag' in res.headers or 'Last-Modified' in res.headers):
+                self.responses[key] = res
+                self.responses.move_to_end(key)
+                while len(self.responses) > self.max_responses:
+                    self.responses.popitem(last=False)
+        return res
+
+    @staticmethod
+    def conditional_headers(cached, headers=None):
+        """Returns headers with the validators of a kept response added."""
+        headers = dict(headers or {})
+        if 'ETag' in cached.headers:
+            headers['If-None-Match'] = cached.headers['ETag']
+        if 'Last-Modified' in cached.headers:
+            headers['If-Modified-Since'] = cached.headers['Last-Modified']
+        return headers
+
+    def close(self):
+        """Closes the session and any pooled connections."""
+        self.responses.clear()
+        self.session.close()
+
+
+class ResponseCache(object):
+    """Last observation of each station, keyed by endpoint and MAC.
+
+    A station uploads once every upload_interval, so until that long has passed since
+    its last observation the API cannot have anything newer, and a poll can be answered
+    from here without going to the network."""
+
+    __slots__ = ('upload_interval', 'clock', 'entries')
+
+    def __init__(self, upload_interval, clock=time.time):
+        self.upload_interval = upload_interval
+        self.clock = clock
+        self.entries = {}
+
+    def store(self, endpoint, readings):
+        """Keeps the (MAC, data) readings of an API response."""
+        now = self.clock()
+        for mac, data in readings:
+            if mac and data and 'dateutc' in data:
+                self.entries[(endpoint, mac.upper())] = (mac, data, now)
+
+    def lookup(self, endpoint, macs):
+        """Returns the kept (MAC, data) of every station in macs, or None if any of them may have uploaded since."""
+        now = self.clock()
+        readings = []
+        for mac in macs:
+            entry = self.entries.get((endpoint, mac))
+            if entry is None:
+                return None
+            original, data, fetched = entry
+            # The next upload is due upload_interval after the observation, a clock skewed
+            # observation time cannot keep the entry longer than upload_interval either
+            if now >= min(data['dateutc'] / 1000.0, fetched) + self.upload_interval:
+                return None
+            readings.append((original, data))
+        return readings
+
+
+def get_json_loads():
+    """Returns the fastest JSON decoder installed: orjson, ujson, or the standard library's."""
+    try:
+        import orjson
+        return orjson.loads
+    except ImportError:
+        pass
+    try:
+        import ujson
+        return ujson.loads
+    except ImportError:
+        return json.loads
+
+
+class AmbientFetcher(object):
+    """Lightweight built-in client for the Ambient REST API, used instead of AmbientAPI.
+
+    api_call() behaves like AmbientAPI.api_call(), returning {} on errors.
+    get_readings() returns the (MAC, last data) of the wanted stations straight from
+    the /devices payload.  Only their lastData objects are decoded, the other devices
+    and the info blocks are skipped."""
+
+    __slots__ = ('endpoint', 'api_key', 'application_key', 'client', 'loads', 'decoder')
+
+    def __init__(self, endpoint, api_key, app_key, http_client):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.application_key = app_key
+        self.client = http_client
+        self.loads = get_json_loads()
+        self.decoder = json.JSONDecoder()
+
+    def get(self, service, **kwargs):
+        """Calls an API service, returning the response."""
+        params = {'applicationKey': self.application_key, 'apiKey': self.api_key}
+        params.update(kwargs)
+        return self.client.get('%s/%s' % (self.endpoint, service), params, verify=True)
+
+    def api_call(self, service, **kwargs):
+        """Calls an API service, returning the decoded JSON, or {} if the call failed."""
+        res = self.get(service, **kwargs)
+        if res.status_code != 200:
+            return {}
+        return self.loads(res.content)
+
+    def get_readings(self, macs=None):
+        """Returns a list of (MAC, last data) of the stations in macs, or of the first station.
+
+        Falls back to decoding the whole payload when the wanted stations cannot be
+        picked out of it, returning every station in that case."""
+        res = self.get('devices')
+        if res.status_code != 200:
+            return []
+        readings = self.extract_readings(res.text, macs)
+        if not readings:
+            readings = [(device.get('macAddress'), device.get('lastData', {})) for device in self.loads(res.content)]
+        return readings
+
+    def extract_readings(self, text, macs=None):
+        """Decodes the lastData of the wanted stations only, returning a list of (MAC, last data).
+
+        Relies on macAddress being the first member of each device, as the API sends it;
+        returns None if the payload is laid out differently."""
+        matches = list(MAC_ADDRESS_PATTERN.finditer(text))
+        readings = []
+        for index, match in enumerate(matches):
+            mac = match.group(1)
+            # Scan back over whitespace rather than copying the payload before each device
+            before = match.start() - 1
+            while before >= 0 and text[before].isspace():
+                before -= 1
+            if before < 0 or text[before] != '{':
+                return None
+            if macs is not None and mac.upper() not in macs:
+                continue
+            end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+            last_data = LAST_DATA_PATTERN.search(text, match.end(), end)
+            if last_data is None:
+                return None
+            start = last_data.end()
+            close = text.find('}', start)
+            data = None
+            if 0 <= close < end and text.find('{', start + 1, close) < 0:
+                # lastData is flat, so it normally ends at the first closing brace
+                try:
+                    data = self.loads(text[start:close + 1])
+                except ValueError:
+                    pass
+            if data is None:
+                data, _ = self.decoder.raw_decode(text, start)
+            readings.append((mac, data))
+            if macs is None:
+                break
+        return readings
+
+
+class PollScheduler(object):
+    """Works out when the next API poll is due.
+
+    Stations upload on a fixed cadence, so the best time to poll is just after an
+    upload has landed.  The phase of that cadence is learned from the dateutc values
+    the API returns.  Deadlines are kept on the monotonic clock and advanced by
+    loop_interval from the previous deadline, so the request time does not add drift."""
+
+    __slots__ = ('loop_interval', 'upload_interval', 'poll_delay', 'min_spacing', 'max_backoff', 'clock', 'wallclock',
+                 'sleep', 'phase', 'deadline', 'failures', 'last_dateutc')
+
+    # Fraction of an upload interval a deadline may come before previous deadline + loop_interval
+    ALIGN_SLACK = 0.25
+
+    def __init__(self, loop_interval, upload_interval=60, poll_delay=5, min_spacing=3, max_backoff=900,
+                 clock=time.monotonic, wallclock=time.time, sleep=time.sleep):
+        self.loop_interval = loop_interval
+        self.upload_interval = upload_interval
+        self.poll_delay = poll_delay
+        self.min_spacing = min_spacing
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.wallclock = wallclock
+        self.sleep = sleep
+        self.phase = None
+        self.deadline = None
+        self.failures = 0
+        self.last_dateutc = None
+
+    def observed(self, dateutc):
+        """Learns the upload phase from an observation time (epoch sec) and schedules the next poll."""
+        phase = dateutc % self.upload_interval
+        if self.phase is None:
+            self.phase = phase
+        elif dateutc != self.last_dateutc:
+            # Move part way towards the new phase, taking the wrap around the interval into account
+            half = self.upload_interval / 2.0
+            diff = (phase - self.phase + half) % self.upload_interval - half
+            self.phase = (self.phase + diff * 0.25) % self.upload_interval
+        self.last_dateutc = dateutc
+        self.failures = 0
+        self.deadline = self.next_aligned()
+        log.debug('Upload phase: %.1f sec, next poll in %.1f sec', self.phase, self.deadline - self.clock())
+
+    def failed(self, status=None, retry_after=None):
+        """Schedules the next poll after a failure.
+
+        Rate limit (429) and server (5xx) responses back off exponentially with jitter,
+        honouring Retry-After when the API sends one.  Anything else keeps the normal cadence."""
+        if status is not None and (status == 429 or status >= 500):
+            self.failures += 1
+            delay = min(self.max_backoff, self.loop_interval * 2 ** (self.failures - 1))
+            delay = max(random.uniform(delay / 2.0, delay), self.min_spacing, retry_after or 0)
+            log.info('API returned status %s, backing off for %.1f sec', status, delay)
+            self.deadline = self.clock() + delay
+        else:
+            self.deadline = self.next_aligned()
+
+    def next_aligned(self):
+        """Returns the monotonic time of the first expected upload at least loop_interval after the last poll.
+
+        The previous deadline plus loop_interval normally lands right on an upload, or just
+        past it when the phase has moved earlier.  Up to ALIGN_SLACK of an upload interval
+        before it is accepted, so clock jitter or a phase correction does not push the poll
+        out to the following upload.  Polls are never closer than min_spacing."""
+        now = self.clock()
+        wall_now = self.wallclock()
+        earliest = now + self.min_spacing
+        target = earliest
+        slack = 0.0
+        if self.deadline is not None and self.deadline + self.loop_interval > earliest:
+            target = self.deadline + self.loop_interval
+            slack = min(target - earliest, self.upload_interval * self.ALIGN_SLACK)
+        if self.phase is None:
+            return target
+        wall = wall_now + (target - now)
+        offset = self.phase + self.poll_delay
+        uploads = math.ceil((wall - slack - offset) / self.upload_interval)
+        return target + (uploads * self.upload_interval + offset - wall)
+
+    def remaining(self):
+        """Returns the seconds until the next poll is due."""
+        if self.deadline is None:
+            return 0
+        return max(0, self.deadline - self.clock())
+
+    def wait(self):
+        """Sleeps until the next poll is due."""
+        remaining = self.remaining()
+        if remaining > 0:
+            self.sleep(remaining)
+
+
+class AsyncPoller(object):
+    """Asyncio core the polling loop runs on.
+
+    Blocking API calls run on a small thread pool under asyncio.wait_for, so a slow
+    response times out rather than stalling the weewx main thread, and several calls
+    can be awaited at once.  Sleeps wait on an event that stop() sets, so shutdown
+    does not have to wait out the sleep.  genLoopPackets() drives it with run()."""
+
+    __slots__ = ('timeout', 'loop', 'executor', 'stopping', 'stopped')
+
+    def __init__(self, timeout, max_workers=2):
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                              thread_name_prefix=DRIVER_NAME)
+        self.stopping = asyncio.Event()
+        self.stopped = False
+
+    def run(self, coro):
+        """Runs a coroutine to completion on the poller's event loop."""
+        return self.loop.run_until_complete(coro)
+
+    async def call(self, func, *args, timeout=None):
+        """Runs a blocking call on the thread pool, raising asyncio.TimeoutError if it takes too long."""
+        future = self.loop.run_in_executor(self.executor, func, *args)
+        return await asyncio.wait_for(future, timeout or self.timeout)
+
+    async def call_all(self, calls, timeout=None):
+        """Runs several (func, args) calls concurrently.
+
+        Returns their results in order, with the exception in place of the result of any call that failed."""
+        return await asyncio.gather(*[self.call(func, *args, timeout=timeout) for func, args in calls],
+                                    return_exceptions=True)
+
+    async def sleep(self, seconds):
+        """Sleeps for up to seconds, returns True if stop() cut the sleep short."""
+        if self.stopped:
+            return True
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stop(self):
+        """Wakes any sleep and makes the following ones return at once.  Safe to call from any thread."""
+        self.stopped = True
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopping.set)
+
+    def close(self):
+        """Closes the event loop and lets the pool threads finish in the background."""
+        if not self.loop.is_closed() and not self.loop.is_running():
+            self.loop.close()
+        self.executor.shutdown(wait=False)
+
+
 class AmbientWeatherAPI(weewx.drivers.AbstractDevice):
     """Custom driver for Ambient Weather API."""
 
     def __init__(self, **stn_dict):
-        log.info('Starting: %s, version: %s' % (DRIVER_NAME, DRIVER_VERSION))
+        log.info('Starting: %s, version: %s', DRIVER_NAME, DRIVER_VERSION)
         rainfile = "%s_%s_rain.txt" % (DRIVER_NAME, DRIVER_VERSION)
         self.loop_interval = float(stn_dict.get('loop_interval', 60))
+        self.upload_interval = float(stn_dict.get('upload_interval', 60))
+        self.poll_delay = float(stn_dict.get('poll_delay', 5))
         self.api_url = stn_dict.get('api_url', 'https://api.ambientweather.net/v1')
         self.api_key = stn_dict.get('api_key')
         self.api_app_key = stn_dict.get('api_app_key')
+        self.api_timeout = float(stn_dict.get('api_timeout', 30))
+        # ambient_api (the default) or builtin, the lightweight fetcher
+        self.api_backend = stn_dict.get('api_backend', 'ambient_api').lower()
+        log.info('api_backend: %s', self.api_backend)
+        self.mode = stn_dict.get('mode', 'poll').lower()
+        self.realtime_url = stn_dict.get('realtime_url', 'https://rt2.ambientweather.net')
+        self.realtime_timeout = float(stn_dict.get('realtime_timeout', 600))
+        log.info('mode: %s', self.mode)
         self.station_hardware = stn_dict.get('hardware', 'Undefined')
         self.use_meteobridge = bool(stn_dict.get('use_meteobridge', False))
-        log.info('use_meteobridge: %s' % str(self.use_meteobridge))
-        self.station_mac = stn_dict.get('station_mac', '')
+        log.info('use_meteobridge: %s', self.use_meteobridge)
+        station_macs = stn_dict.get('station_mac', '')
+        if isinstance(station_macs, str):
+            station_macs = station_macs.split(',')
+        station_macs = [mac.strip().upper() for mac in station_macs if mac.strip()]
+        station_prefixes = stn_dict.get('station_prefix', [])
+        if isinstance(station_prefixes, str):
+            station_prefixes = [station_prefixes]
+        self.station_mac = station_macs[0] if station_macs else ''
+        self.station_macs = frozenset(station_macs)
         self.use_station_mac = False
         if not self.station_mac:
             log.info("No Station MAC specified.  The first station will be returned.")
         else:
-            log.info("Using Station MAC: %s" % self.station_mac)
+            log.info("Using Station MAC: %s", ', '.join(station_macs))
             self.use_station_mac = True
-        self.rainfilepath = os.path.join(tempfile.gettempdir(), rainfile)
+        # Rain files of earlier versions are only read to seed the state store
+        self.legacy_rainfilepath = os.path.join(tempfile.gettempdir(), rainfile)
+        self.state_file = stn_dict.get('state_file',
+                                       os.path.join(tempfile.gettempdir(), "%s_state.json" % DRIVER_NAME))
+        self.rain_state = RainStateStore(self.state_file, float(stn_dict.get('state_flush_interval', 0)))
         self.aw_log_level = None
+        # aw_debug = N dumps one full observation and packet every N loops
         self.aw_debug = int(stn_dict.get('aw_debug', 0))
-        log.info('aw_debug: %s' % str(self.aw_debug))
-        if self.aw_debug == 1:
+        log.info('aw_debug: %s', self.aw_debug)
+        if self.aw_debug > 0:
             self.aw_log_level = "info"
-        log.info('aw_log_level: %s' % str(self.aw_log_level))
-        log.info('Using rain file: %s' % str(self.rainfilepath))
-        log.info('Loaded: %s, version: %s' % (DRIVER_NAME, DRIVER_VERSION))
+        self.loop_count = 0
+        # Resolved once, so the per-packet code does not build debug messages nobody sees
+        self.log_debug = log.isEnabledFor(logging.DEBUG)
+        log.info('aw_log_level: %s', self.aw_log_level)
+        log.info('Using state file: %s', self.state_file)
+        # Only fields the archive stores (or that are whitelisted) are sent to weewx
+        self.packet_filter = stn_dict.get('packet_filter', 'schema').lower()
+        extra_fields = stn_dict.get('extra_fields', [])
+        if isinstance(extra_fields, str):
+            extra_fields = extra_fields.split(',')
+        self.emit_fields = None
+        if self.packet_filter == 'schema':
+            schema_columns = stn_dict.get('schema_columns')
+            if schema_columns is None:
+                schema_columns = get_schema_columns()
+            self.emit_fields = set(schema_columns) | set(field.strip() for field in extra_fields if field.strip())
+        log.info('packet_filter: %s', self.packet_filter)
+        # Observations StdWXCalculate would otherwise work out for every packet are filled in here
+        self.derive_observations = weeutil.weeutil.to_bool(stn_dict.get('derived_observations', True))
+        self.derived_fields = self.station_derived_fields()
+        self.altitude_ft = get_altitude_ft(stn_dict.get('altitude'))
+        self.latitude = to_float(stn_dict.get('latitude'))
+        self.longitude = to_float(stn_dict.get('longitude'))
+        self.rain_period = float(stn_dict.get('rain_period', 900))
+        log.info('Derived observations: %s', ', '.join(self.derived_fields) or 'none')
+        # Packets are converted to this unit system here, once, rather than by StdConvert downstream
+        unit_system = stn_dict.get('unit_system', 'US').upper()
+        if unit_system not in weewx.units.unit_constants:
+            log.error("Unknown unit_system '%s', sending US units", unit_system)
+            unit_system = 'US'
+        self.unit_system = weewx.units.unit_constants[unit_system]
+        self.unit_converter = make_unit_converter(self.unit_system) if self.unit_system != weewx.US else None
+        log.info('unit_system: %s', unit_system)
+        # Ambient fields without a weewx field, reported once.  dateutc and dailyrainin feed dateTime and rain.
+        self.unmapped_fields = set(['dateutc', 'dailyrainin'])
+        self.packet_plan = self.compile_packet_plan()
+        self.packet_plan_by_field = self.index_packet_plan(self.packet_plan)
+        self.rain_key = self.station_rain_key()
+        # The first station keeps the plain weewx names, the others get a prefix
+        self.stations = self.make_stations(station_macs, station_prefixes)
+        self.last_dateutc = {}
+        self.last_packet_ts = None
+        self.stats = DriverStats(int(stn_dict.get('stats_window', 256)))
+        self.stats_file = stn_dict.get('stats_file')
+        self.stats_format = stn_dict.get('stats_format', 'json').lower()
+        self.stats_interval = float(stn_dict.get('stats_interval', 60))
+        self.stats_written = None
+        if self.stats_file:
+            log.info('Writing %s stats to: %s', self.stats_format, self.stats_file)
+        self.max_backfill_pages = int(stn_dict.get('max_backfill_pages', 7))
+        # Outages at least this long are queued and handed to weewx as archive records
+        self.gap_catchup = float(stn_dict.get('gap_catchup', 600))
+        self.queue_file = stn_dict.get('queue_file',
+                                       os.path.join(tempfile.gettempdir(), "%s_queue.jsonl" % DRIVER_NAME))
+        self.offline_queue = OfflineQueue(self.queue_file, int(stn_dict.get('queue_size', 2016)))
+        self.primary_mac = None
+        log.info('Using queue file: %s', self.queue_file)
+        # Requests of every driver on the host sharing these keys are paced through one file.  Off unless
+        # configured, as every request rewrites the file; setting rate_limit_file turns it on.
+        self.rate_limit = weeutil.weeutil.to_bool(stn_dict.get('rate_limit', 'rate_limit_file' in stn_dict))
+        self.rate_limit_file = stn_dict.get('rate_limit_file',
+                                            os.path.join(tempfile.gettempdir(), "%s_ratelimit.json" % DRIVER_NAME))
+        self.api_key_rate = float(stn_dict.get('api_key_rate', 1.0))
+        self.app_key_rate = float(stn_dict.get('app_key_rate', 3.0))
+        if self.rate_limit:
+            log.info('Using rate limit file: %s', self.rate_limit_file)
+        self.rate_limiter = self.make_rate_limiter(self.api_key, self.api_app_key)
+        # Polls before the next upload is due are answered from the last response, later ones revalidate it
+        self.response_cache = None
+        if weeutil.weeutil.to_bool(stn_dict.get('response_cache', True)):
+            self.response_cache = ResponseCache(self.upload_interval)
+        log.info('response_cache: %s', self.response_cache is not None)
+        # requests' connection failures, known once the first HTTP client has imported it
+        self.connection_errors = ()
+        # Other accounts are polled alongside this one, their stations' fields get the account's prefix
+        self.accounts = [Account('default', self.api_key, self.api_app_key, self.api_timeout, self.stations,
+                                 station_macs, self.rate_limiter)]
+        for name, account_dict in stn_dict.get('accounts', {}).items():
+            self.accounts.append(self.make_account(name, account_dict))
+        if self.mode == 'realtime' and len(self.accounts) > 1:
+            log.info('Realtime mode only follows the first account, the others are polled if it falls back')
+        # With several accounts a poll only waits this long for the slower ones, they join a later poll
+        self.merge_wait = float(stn_dict.get('merge_wait', 5))
+        self.archive_period = int(stn_dict.get('archive_period', 300))
+        self.poller = AsyncPoller(self.api_timeout,
+                                  max_workers=int(stn_dict.get('poll_threads', min(8, len(self.accounts) + 1))))
+        self.scheduler = PollScheduler(self.loop_interval, upload_interval=self.upload_interval,
+                                       poll_delay=self.poll_delay)
+        log.info('Loaded: %s, version: %s', DRIVER_NAME, DRIVER_VERSION)
         log.debug("Exiting init()")
 
+    def make_stations(self, station_macs, station_prefixes, account_prefix=''):
+        """Returns the Stations of an account.  The first one gets account_prefix, the others a numbered prefix."""
+        stations = []
+        for index, mac in enumerate(station_macs or [None]):
+            if index < len(station_prefixes):
+                prefix = station_prefixes[index]
+            else:
+                prefix = account_prefix + ('' if index == 0 else 'station%d_' % (index + 1))
+            plan_by_field = self.packet_plan_by_field
+            rain_key = self.station_rain_key(prefix)
+            if prefix:
+                packet_plan = self.compile_packet_plan(prefix)
+                plan_by_field = self.index_packet_plan(packet_plan, prefix)
+                keys = [key for key, field, convert in packet_plan] + list(self.station_derived_fields(prefix))
+                if rain_key is not None:
+                    keys.append('rain')
+                registered = register_accumulators(prefix, keys)
+                if registered:
+                    log.info('Accumulator entries added for: %s', ', '.join(registered))
+            stations.append(Station(mac, prefix, plan_by_field, self.make_derived(prefix), rain_key))
+            if mac is not None:
+                log.info("Station %s uses prefix '%s'", mac, prefix)
+        return stations
+
+    def make_rate_limiter(self, api_key, app_key):
+        """Returns the shared rate limiter for a pair of keys, or None if rate limiting is off."""
+        if not self.rate_limit:
+            return None
+        buckets = [(rate_limit_bucket('api', api_key), self.api_key_rate),
+                   (rate_limit_bucket('app', app_key), self.app_key_rate)]
+        return SharedRateLimiter(self.rate_limit_file, buckets)
+
+    def make_account(self, name, account_dict):
+        """Returns an Account from its [[accounts]] subsection.  Keys and timeout default to the driver's."""
+        api_key = account_dict.get('api_key')
+        app_key = account_dict.get('api_app_key', self.api_app_key)
+        station_macs = account_dict.get('station_mac', '')
+        if isinstance(station_macs, str):
+            station_macs = station_macs.split(',')
+        station_macs = [mac.strip().upper() for mac in station_macs if mac.strip()]
+        station_prefixes = account_dict.get('station_prefix', [])
+        if isinstance(station_prefixes, str):
+            station_prefixes = [station_prefixes]
+        prefix = account_dict.get('prefix', '%s_' % name)
+        log.info("Account %s uses prefix '%s'", name, prefix)
+        stations = self.make_stations(station_macs, station_prefixes, prefix)
+        return Account(name, api_key, app_key, float(account_dict.get('api_timeout', self.api_timeout)),
+                       stations, station_macs, self.make_rate_limiter(api_key, app_key))
+
     @property
     def hardware_name(self):
         """Returns the type of station."""
         log.debug("calling: hardware_name")
         return self.station_hardware
 
+    @property
+    def duplicates_dropped(self):
+        """Returns the number of observations dropped because they were already sent."""
+        return self.stats.counters['duplicates']
+
     @property
     def archive_interval1(self):
         """Returns the archive internal."""
         log.debug("calling: archive_interval")
         return self.loop_interval
 
+    def get_api(self, account=None):
+        """Returns the API client of an account (the first by default), creating it and its pooled
+        HTTP session on first use.
+
+        ambient_api is only imported here, so it is not loaded at all with the builtin backend."""
+        account = account or self.accounts[0]
+        if account.api is None:
+            account.http = AmbientHTTPClient(timeout=account.timeout, rate_limiter=account.rate_limiter,
+                                             max_wait=account.max_wait, revalidate=self.response_cache is not None)
+            self.connection_errors = account.http.connection_errors
+            if self.api_backend == 'builtin':
+                log.debug("Creating builtin API client")
+                account.api = AmbientFetcher(self.api_url, account.api_key, account.app_key, account.http)
+                return account.api
+            log.debug("Creating AmbientAPI client")
+            from ambient_api.ambientapi import AmbientAPI
+            account.api = AmbientAPI(AMBIENT_ENDPOINT=self.api_url,
+                                     AMBIENT_API_KEY=account.api_key,
+                                     AMBIENT_APPLICATION_KEY=account.app_key,
+                                     log_level=self.aw_log_level,
+                                     http_client=account.http)
+            # ambient_api prefers its own settings module over AMBIENT_ENDPOINT, so set the URL explicitly
+            account.api.endpoint = self.api_url
+        return account.api
+
+    def reset_api(self, account=None):
+        """Drops the API client of an account (the first by default) so its next poll opens a fresh connection."""
+        account = account or self.accounts[0]
+        if account.http is not None:
+            account.http.close()
+        account.http = None
+        account.api = None
+
+    def fetch_history(self, mac, since_ms=None, max_pages=1):
+        """Pages backwards through the device history, returning (pages newest first, previous record).
+
+        Each page is the raw records newer than since_ms, in API order.  Paging stops at
+        since_ms, at max_pages, or when the history runs out.  The previous record is the
+        newest one at or before since_ms, if paging reached it, else None."""
+        pages = []
+        previous = None
+        end_date = None
+        limit = HISTORY_PAGE_SIZE
+        if since_ms is not None:
+            # A short gap does not need a full page
+            missed = (time.time() * 1000 - since_ms) / (HISTORY_INTERVAL * 60000)
+            limit = max(1, min(HISTORY_PAGE_SIZE, int(math.ceil(missed)) + 1))
+        while len(pages) < max_pages:
+            if pages and self.rate_limiter is None:
+                # Stay under the API rate limit between pages
+                time.sleep(self.scheduler.min_spacing)
+            page = self.get_device_history(mac, end_date, limit)
+            if not page:
+                break
+            oldest = min(record['dateutc'] for record in page)
+            if since_ms is not None:
+                older = [record for record in page if record['dateutc'] <= since_ms]
+                if older:
+                    previous = max(older, key=lambda record: record['dateutc'])
+                page = [record for record in page if record['dateutc'] > since_ms]
+            pages.append(page)
+            log.debug('History page of %d records ending %s', len(page), end_date)
+            if since_ms is None or oldest <= since_ms or len(page) < limit:
+                break
+            end_date = oldest - 1
+            limit = HISTORY_PAGE_SIZE
+        return pages, previous
+
+    def get_device_history(self, mac, end_date=None, limit=HISTORY_PAGE_SIZE):
+        """Returns up to limit history records for a device, newest first, ending at end_date (epoch ms)."""
+        params = {'limit': limit}
+        if end_date:
+            params['endDate'] = end_date
+        return self.get_api().api_call('devices/%s' % mac, **params)
+
+    def get_api_status(self, account=None):
+        """Returns the HTTP status and Retry-After seconds (or None) of the last API response of an account."""
+        http = (account or self.accounts[0]).http
+        if http is None or http.last_status is None:
+            return None, None
+        retry_after = http.last_headers.get('Retry-After')
+        try:
+            retry_after = float(retry_after)
+        except (TypeError, ValueError):
+            retry_after = None
+        return http.last_status, retry_after
+
+    def write_stats(self, force=False):
+        """Writes the stats file if one is configured and stats_interval has passed since the last write."""
+        if not self.stats_file:
+            return
+        now = time.monotonic()
+        if force or self.stats_written is None or now - self.stats_written >= self.stats_interval:
+            try:
+                self.stats.write(self.stats_file, self.stats_format)
+            except (IOError, OSError) as e:
+                log.error("Could not write stats file %s: %s", self.stats_file, e)
+            self.stats_written = now
+
+    def closePort(self):
+        """Stops the polling loop, releases the pooled HTTP connections and writes out the rain state."""
+        self.poller.stop()
+        for account in self.accounts:
+            if account.fetch is not None:
+                account.fetch.cancel()
+                account.fetch = None
+        self.poller.close()
+        for account in self.accounts:
+            self.reset_api(account)
+        self.write_stats(force=True)
+        try:
+            self.rain_state.flush()
+        except (IOError, OSError) as e:
+            log.error("Could not write state file %s: %s", self.state_file, e)
+
     def convert_epoch_ms_to_sec(self, epoch_ms):
         """Converts a epoch that's in ms to sec.
         AmbientAPI returns the epoch time in ms not sec"""
-        log.debug("calling: convert_epoch_ms_to_sec")
         utc_epoch_sec = epoch_ms / 1000
         return utc_epoch_sec
 
     def print_dict(self, data_dict):
         """Prints a dict."""
-        if self.aw_debug == 1:
-            log.debug("calling: print_dict")
-            for key in data_dict:
-                log.debug(key + " = " + str(data_dict[key]))
-
-    def get_value(self, data_dict, key):
-        """Gets the value from a dict, returns None if the key does not exist."""
-        log.debug("calling: get_value")
-        return data_dict.get(key, None)
-
-    def get_float(self, value):
-        """Checks if a value is not, if not it performs a converstion to a float()"""
-        log.debug("calling: get_float")
-        if value is None:
-            return value
-        else:
-            return float(value)
+        for key, value in data_dict.items():
+            log.info("%s = %s", key, value)
 
-    def get_battery_status(self, value):
-        """Converts the AM API battery status to somthing weewx likes."""
-        log.debug("calling: get_battery_status")
-        if value is None:
-            return None
-        if (value <= 0):
-            if self.use_meteobridge:
-                log.debug("use_meteobridge flip bit to 0.0")
-                return 0.0
-            else:
-                return 1.0
-        else:
-            if self.use_meteobridge:
-                log.debug("use_meteobridge flip bit to 1.0")
-                return 1.0
-            else:
-                return 0.0
+    def debug_sample(self):
+        """Counts a loop, returns True if aw_debug says its observations should be dumped."""
+        self.loop_count += 1
+        return self.aw_debug > 0 and self.loop_count % self.aw_debug == 0
+
+    def dump_observation(self, mac, data, _packet, station=None):
+        """Logs an Ambient observation, the packet built from it and the mapped fields it lacks."""
+        log.info("============Ambient observation of station %s============", mac)
+        self.print_dict(data)
+        log.info("============weewx packet============")
+        self.print_dict(_packet)
+        plan = station.plan_by_field if station is not None else self.packet_plan_by_field
+        for field, targets in plan.items():
+            if field not in data:
+                for key, convert in targets:
+                    log.info("Weewx value: '%s' not found in AW JSON packet.", key)
 
-    def check_rain_rate(self, dailyrainin):
-        """Read previous daily rain total, and write most recent daily rain back to file"""
+    def check_rain_rate(self, dailyrainin, mac=None):
+        """Read previous daily rain total of the station, and record the most recent daily rain"""
         correctedRain = dailyrainin
         try:
-            if path.exists(self.rainfilepath):
-                log.debug('Opening file: %s' % (self.rainfilepath))
-                intervalRain = open(self.rainfilepath, 'r')
-                try:
-                    lastRain = float(intervalRain.read())
-                except ValueError:
-                    log.error('String value found. Assuming zero interval rain and recording current value')
-                    lastRain = dailyrainin
-                intervalRain.close()
-                log.debug('Previous daily rain: %s' % str(lastRain))
-            else:
-                log.debug('No previous value found for rain, assuming interval of 0 and recording daily value')
+            lastRain = self.get_last_rain(mac)
+            if lastRain is None:
+                if self.log_debug:
+                    log.debug('No previous value found for rain, assuming interval of 0 and recording daily value')
                 lastRain = dailyrainin
 
             if dailyrainin is None:
                 log.info("Daily rain (from API) is none, skipping calculation")
                 return 0
 
-            if lastRain is None:
-                log.info("Previous rain (from cache) is none, skipping calculation")
-                return 0
-
-            log.debug('Reported daily rain: %s' % str(dailyrainin))
-
-            if lastRain > dailyrainin:
-                correctedRain = dailyrainin
-                log.debug('Recorded rain is more than reported rain; using reported rain')
-            else:
-                correctedRain = dailyrainin - lastRain
-                # temp
-                # log.info('Previous daily rain: %s' % str(lastRain))
-                # log.info('Reported daily rain: %s' % str(dailyrainin))
-                # log.info('Calculated interval rain: %s' % str(correctedRain))
-
-            log.debug('Calculated interval rain: %s' % str(correctedRain))
-            intervalRain = open(self.rainfilepath, 'w')
-            intervalRain.write(str(dailyrainin))
-            intervalRain.close()
+            correctedRain = interval_rain(lastRain, dailyrainin)
+            if self.log_debug:
+                log.debug('Previous daily rain: %s, reported daily rain: %s, interval rain: %s',
+                          lastRain, dailyrainin, correctedRain)
+            self.rain_state.set(mac, dailyrainin)
 
         except Exception as e:
-            log.error("%s driver, function: %s encountered an error." % (DRIVER_NAME, "check_rain_rate"))
-            log.error("Error caught was: %s" % e)
+            log.error("%s driver, function: %s encountered an error.", DRIVER_NAME, "check_rain_rate")
+            log.error("Error caught was: %s", e)
 
         return correctedRain
 
+    def get_last_rain(self, mac):
+        """Returns the previous daily rain total of a station, or None.
+
+        The first station without a recorded total picks up the rain file of an earlier driver version."""
+        lastRain = self.rain_state.get(mac)
+        if lastRain is None and self.legacy_rainfilepath is not None:
+            if path.exists(self.legacy_rainfilepath):
+                log.info('Reading previous daily rain from: %s', self.legacy_rainfilepath)
+                try:
+                    with open(self.legacy_rainfilepath, 'r') as intervalRain:
+                        lastRain = float(intervalRain.read())
+                except (IOError, OSError, ValueError) as e:
+                    log.error('Could not read previous daily rain: %s', e)
+            self.legacy_rainfilepath = None
+        return lastRain
+
     def get_packet_mapping(self):
         """Gets the mapping of weewx values (key) to AmbientAPI values (value)."""
         return {
@@ -274,112 +1648,506 @@ class AmbientWeatherAPI(weewx.drivers.AbstractDevice):
             'UV': 'uv'
         }
 
-    def genLoopPackets(self):
-        log.debug("calling: genLoopPackets")
+    def emits(self, key):
+        """Tells if a packet key is sent to weewx, that is the archive stores it or extra_fields lists it."""
+        return self.emit_fields is None or key in self.emit_fields
 
-        while True:
-            # Query the API to get the latest reading.
+    def station_derived_fields(self, prefix=''):
+        """Returns the derived observations of a station with the given prefix, sent under their prefixed name."""
+        if not self.derive_observations:
+            return ()
+        return tuple(name for name in DERIVED_FIELDS if self.emits(prefix + name))
+
+    def station_rain_key(self, prefix=''):
+        """Returns the packet key of a station's interval rain, or None if it is neither sent nor used for rainRate."""
+        if self.emits(prefix + 'rain') or 'rainRate' in self.station_derived_fields(prefix):
+            return prefix + 'rain'
+        return None
+
+    def compile_packet_plan(self, prefix=''):
+        """Compiles get_packet_mapping() into a tuple of (weewx key, Ambient key, converter).
+
+        Fields the archive schema does not store are left out, unless whitelisted in extra_fields.
+        A station's fields are looked up under the prefixed names they are sent as, so a
+        second station only sends the fields given their own columns or extra_fields entries.
+
+        Done once at startup so the packet build does not rebuild the mapping or
+        re-test the battery prefix for every field of every packet."""
+        battery_status = make_battery_converter(self.use_meteobridge)
+        derived_fields = self.station_derived_fields(prefix)
+        plan = []
+        dropped = []
+        for key, field in self.get_packet_mapping().items():
+            if key in derived_fields:
+                # Worked out by DerivedObservations instead
+                continue
+            if not self.emits(prefix + key):
+                dropped.append(prefix + key)
+                continue
+            convert = battery_status if field.startswith('batt') else to_float
+            plan.append((key, field, convert))
+        if dropped:
+            log.info('Not sending mapped fields the archive does not store: %s', ', '.join(sorted(dropped)))
+        return tuple(plan)
+
+    def make_derived(self, prefix=''):
+        """Returns a DerivedObservations for a station with the given prefix, or None if there is nothing to derive."""
+        derived_fields = self.station_derived_fields(prefix)
+        if not derived_fields:
+            return None
+        max_gap = 2 * max(self.loop_interval, self.upload_interval)
+        return DerivedObservations(prefix, derived_fields, self.altitude_ft, self.latitude, self.longitude,
+                                   self.rain_period, max_gap, self.unit_system)
+
+    def index_packet_plan(self, packet_plan, prefix=''):
+        """Indexes a packet plan by Ambient field, so a packet build only visits fields present in the data.
+
+        Returns a dict of Ambient field -> ((weewx key, converter), ...) with the weewx keys prefixed.
+        With a unit_system other than US the converters also convert the units of their key,
+        looked up without the prefix so every field of the packet is in its usUnits."""
+        plan_by_field = {}
+        for key, field, convert in packet_plan:
+            to_unit = self.unit_converter(key) if self.unit_converter is not None else None
+            if to_unit is not None:
+                convert = with_unit_conversion(convert, to_unit)
+            plan_by_field.setdefault(field, []).append((prefix + key, convert))
+        return dict((field, tuple(targets)) for field, targets in plan_by_field.items())
+
+    def build_packet(self, data, rain, station=None):
+        """Builds a weewx loop packet from an Ambient observation and the corrected interval rain (in inches)."""
+        rain_key = station.rain_key if station is not None else self.rain_key
+        _packet = {
+            'dateTime': self.convert_epoch_ms_to_sec(data["dateutc"]),
+            'usUnits': self.unit_system,
+        }
+        if rain_key is not None:
+            if self.unit_converter is not None and rain is not None:
+                to_unit = self.unit_converter('rain')
+                if to_unit is not None:
+                    rain = to_unit(rain)
+            _packet[rain_key] = rain
+
+        # Key is Ambient value, value is the weewx packet fields it feeds
+        # Loop the values in the API data and look them up in the compiled plan
+        plan = station.plan_by_field if station is not None else self.packet_plan_by_field
+        for field, value in data.items():
+            targets = plan.get(field)
+            if targets is not None:
+                for key, convert in targets:
+                    _packet[key] = convert(value)
+            elif field not in self.unmapped_fields:
+                self.unmapped_fields.add(field)
+                log.info("Ambient field '%s' is not sent to weewx", field)
+        return _packet
+
+    def select_stations(self, readings, fallback=True, account=None):
+        """Pairs each configured station of an account (the first by default) with its reading.
+
+        readings is a list of (MAC, data).  Returns a list of (Station, MAC, data).  Falls
+        back to the first reading when no MAC is configured or, if fallback is set, none of
+        the configured MACs were found."""
+        account = account or self.accounts[0]
+        stations = account.stations
+        if not account.use_station_mac:
+            mac, data = readings[0]
+            return [(stations[0], mac, data)]
+        by_mac = dict(((mac or '').upper(), (mac, data)) for mac, data in readings)
+        selected = []
+        for station in stations:
+            reading = by_mac.get(station.mac)
+            if reading is None:
+                if self.log_debug:
+                    log.debug('Station MAC %s not found in the API payload', station.mac)
+            else:
+                selected.append((station, reading[0], reading[1]))
+        if not selected and fallback:
+            log.debug('Specified MAC not found, using first station.')
+            mac, data = readings[0]
+            selected.append((stations[0], mac, data))
+        return selected
+
+    def new_observations(self, selected):
+        """Drops the (Station, MAC, data) observations whose dateutc was already sent."""
+        observations = []
+        for station, mac, data in selected:
+            # Stations upload less often than the API may be polled, drop observations already sent
+            if data["dateutc"] == self.last_dateutc.get(mac):
+                self.stats.increment('duplicates')
+                log.debug('Observation %s already sent for station %s, duplicates dropped: %d',
+                          data["dateutc"], mac, self.duplicates_dropped)
+            else:
+                observations.append((station, mac, data))
+        return observations
+
+    def fetch_readings(self, account=None):
+        """Calls the devices endpoint of an account (the first by default) and returns a list of (MAC, last data).
+
+        AmbientAPI returns every station on the account, the builtin fetcher only the configured ones.
+        While none of the account's stations can have uploaded since the last call, the
+        response cache answers instead of the API."""
+        account = account or self.accounts[0]
+        endpoint = '%s/devices' % self.api_url
+        if self.response_cache is not None and account.cached_macs:
+            readings = self.response_cache.lookup(endpoint, account.cached_macs)
+            if readings is not None:
+                self.stats.increment('cache_hits')
+                return readings
+
+        # get the API client, it is only created on the first poll or after a connection failure
+        with self.stats.timer('api_init'):
+            weather = self.get_api(account)
+
+        # one call returns every station on the account
+        with self.stats.timer('get_devices'):
+            if self.api_backend == 'builtin':
+                readings = weather.get_readings(account.station_macs if account.use_station_mac else None)
+            else:
+                readings = [(device.mac_address, device.last_data) for device in weather.get_devices()]
+        if not readings:
+            raise Exception('AmbientAPI get_devices() returned empty dict')
+        if self.response_cache is not None:
+            if account.http is not None and account.http.last_status == 304:
+                self.stats.increment('not_modified')
+            self.response_cache.store(endpoint, readings)
+            if account.use_station_mac:
+                account.cached_macs = [mac.upper() for mac, _ in readings
+                                       if mac and mac.upper() in account.station_macs]
+            else:
+                account.cached_macs = [readings[0][0].upper()] if readings[0][0] else []
+        return readings
+
+    def genArchiveRecords(self, since_ts):
+        """Yields the observations queued during an API outage, then raises NotImplementedError.
+
+        With record_generation = hardware weewx calls this at the end of every archive
+        period; the NotImplementedError makes it build the period's own record from the
+        loop packets.  Answering from the device history every period instead would
+        archive Ambient's five minute records, cost an API call each period, and leave a
+        hole whenever that call fails.  With record_generation = software weewx never
+        calls this and the queue waits for genStartupRecords()."""
+        station = self.stations[0]
+        mac = station.mac or self.primary_mac
+        if mac is not None and self.offline_queue.pending(mac):
             try:
-                error_occured = False
-                log.debug("starting getLoopPackets")
-
-                # Adding an extra buffer so the API throttle limit isn't hit
-                log.debug("sleeping an extra 3 seconds to not hit API throttle limit.")
-                time.sleep(3)
-
-                # init the API
-                weather = AmbientAPI(AMBIENT_ENDPOINT=self.api_url,
-                                     AMBIENT_API_KEY=self.api_key,
-                                     AMBIENT_APPLICATION_KEY=self.api_app_key,
-                                     log_level=self.aw_log_level)
-                log.debug("Init API call returned")
-
-                # get the first device
-                devices = weather.get_devices()
-                log.debug("Got weather devices")
-                if not devices:
-                    log.error('AmbientAPI get_devices() returned empty dict')
-                    raise Exception('AmbientAPI get_devices() returned empty dict')
-                else:
-                    log.debug('Weather get_devices() payload not empty')
-
-                # get the last report dict for the first station
-                data = devices[0].last_data
-                # check to see if the user wants a specific MAC
-                if self.use_station_mac:
-                    log.debug('Searching for specific Station MAC')
-                    for device in devices:
-                        if device.mac_address == self.station_mac:
-                            log.info("Using station mac: %s" % self.station_mac)
-                            data = device.last_data
-                            break
-                        else:
-                            log.debug('Specified MAC not found, using first station.')
-                # info = devices[0].info
-                log.debug("Got last report")
-
-                # Convert the epoch to the format weewx wants.
-                current_observation = self.convert_epoch_ms_to_sec(data["dateutc"])
-
-                # output the observation
-                self.print_dict(data)
+                queued, rain_before = self.offline_queue.drain(mac)
+            except (IOError, OSError) as e:
+                log.error("Could not write queue file %s: %s", self.queue_file, e)
+            else:
+                log.info("Sending %d observations queued during an API outage", len(queued))
+                for record in self.build_archive_records(queued, rain_before, station,
+                                                         self.make_derived(station.prefix)):
+                    yield record
+        raise NotImplementedError("Method 'genArchiveRecords' not implemented")
+
+    def genStartupRecords(self, since_ts):
+        """Yields archive records for the observations weewx missed while it was down, oldest first.
+
+        weewx only calls this at startup.  Observations queued during an API outage come
+        first, whatever their age, then the device history newer than since_ts (or the
+        newest queued observation).  The history endpoint is paged backwards in requests
+        of up to HISTORY_PAGE_SIZE records, at most max_backfill_pages of them.  Only the
+        raw pages are kept, each one is converted when its turn comes to be yielded.  Only
+        the first station is backfilled.
+
+        The interval rain of the first record is worked out from the history record
+        before since_ts, never from the rain state, which may hold a newer daily total."""
+        log.debug("calling: genStartupRecords")
+        station = self.stations[0]
+        # History records get their own rolling state, the loop packets' is left alone
+        derived = self.make_derived(station.prefix)
+        since_ms = since_ts * 1000 if since_ts else None
+        mac = station.mac or self.primary_mac
+        pages = []
+        queued = []
+        previous = None
+        try:
+            if mac is None:
+                mac = self.fetch_readings()[0][0]
+            queued, rain_before = self.offline_queue.drain(mac)
+            if queued:
+                log.info("Sending %d observations queued during an API outage", len(queued))
+                pages.append(list(reversed(queued)))
+                since_ms = max(since_ms or 0, queued[-1]['dateutc'])
+            history, previous = self.fetch_history(mac, since_ms, self.max_backfill_pages)
+            pages[:0] = history
+        except self.connection_errors as e:
+            log.error(DRIVER_NAME + " driver could not reach the API for the backfill.")
+            log.error("Error caught was: %s", e)
+            self.reset_api()
+        except Exception as e:
+            log.error(DRIVER_NAME + " driver encountered an error during the backfill.")
+            log.error("Error caught was: %s", e)
+
+        last_rain = None
+        if queued:
+            last_rain = rain_before
+        elif previous is not None:
+            last_rain = to_float(previous.get('dailyrainin'))
+        last_dateutc = None
+        count = 0
+        for page in reversed(pages):
+            page.sort(key=lambda record: record['dateutc'])
+            for record in self.build_archive_records(page, last_rain, station, derived):
+                count += 1
+                yield record
+            for data in page:
+                if data.get('dailyrainin') is not None:
+                    last_rain = float(data['dailyrainin'])
+                last_dateutc = data['dateutc']
+        if last_dateutc is not None:
+            log.info("Backfilled %d archive records", count)
+            self.last_dateutc[mac] = max(last_dateutc, self.last_dateutc.get(mac, 0))
+            if last_rain is not None and last_dateutc >= self.last_dateutc[mac]:
+                self.rain_state.set(mac, last_rain)
+
+    def note_outage(self):
+        """Records an outage of the first station, if it has sent an observation to weewx."""
+        mac = self.primary_mac
+        if self.gap_catchup > 0 and mac is not None and mac in self.last_dateutc:
+            try:
+                self.offline_queue.mark_outage(mac, self.last_dateutc[mac], self.rain_state.get(mac))
+            except (IOError, OSError) as e:
+                log.error("Could not write queue file %s: %s", self.queue_file, e)
 
+    async def recover_outage(self, data):
+        """Queues the observations of the first station missed during an outage that just ended.
+
+        The rain state moves on to the newest queued observation, so the next loop packet
+        only counts rain that fell after it; the queued observations carry the rain of the gap."""
+        mac = self.primary_mac
+        outage = self.offline_queue.outages.get(mac)
+        if outage is None:
+            return
+        since_ms = outage[0]
+        records = []
+        if data["dateutc"] - since_ms >= self.gap_catchup * 1000:
+            log.info("API outage of station %s ended, fetching the missed observations", mac)
+            try:
+                page_timeout = self.api_timeout + self.accounts[0].max_wait
+                pages, _ = await self.poller.call(self.fetch_history, mac, since_ms, self.max_backfill_pages,
+                                                  timeout=page_timeout * self.max_backfill_pages)
+                # The observation that ended the outage goes to weewx as a loop packet
+                records = sorted((record for page in pages for record in page
+                                  if record['dateutc'] < data['dateutc']), key=lambda record: record['dateutc'])
             except Exception as e:
-                syslog.syslog(DRIVER_NAME + " driver encountered an error.")
-                log.error(DRIVER_NAME + " driver encountered an error.")
-                syslog.syslog("Error caught was: %s" % e)
-                log.error("Error caught was: %s" % e)
-                error_occured = True
+                log.error("Could not fetch the observations missed during the outage: %s", e)
+        self.offline_queue.end_outage(mac, records)
+        if records:
+            log.info("Queued %d observations missed during the outage", len(records))
+            self.last_dateutc[mac] = records[-1]['dateutc']
+            if records[-1].get('dailyrainin') is not None:
+                self.rain_state.set(mac, float(records[-1]['dailyrainin']))
+
+    def build_archive_records(self, page, last_rain, station, derived=None):
+        """Converts a page of history records, oldest first, into archive records.
+
+        Interval rain is worked out from consecutive daily totals, starting from last_rain.
+        derived, if given, adds the derived observations."""
+        rains = []
+        for data in page:
+            dailyrainin = to_float(data.get('dailyrainin'))
+            rain = None
+            if dailyrainin is not None:
+                rain = 0.0 if last_rain is None else interval_rain(last_rain, dailyrainin)
+                last_rain = dailyrainin
+            rains.append(rain)
+        records = [self.build_packet(data, rain, station) for data, rain in zip(page, rains)]
+        for record in records:
+            record['interval'] = HISTORY_INTERVAL
+            if derived is not None:
+                derived.add(record, HISTORY_INTERVAL)
+        return records
+
+    def build_observation_packet(self, station, mac, data):
+        """Corrects the rain and builds the loop packet of a (Station, MAC, data) observation.
+
+        Returns None if the packet could not be built."""
+        try:
+            dailyrainin = 0.0
+            # Check the API for dai
+            if 'dailyrainin' in data:
+                dailyrainin = to_float(data['dailyrainin'])
+
+            with self.stats.timer('rain'):
+                rain = self.check_rain_rate(dailyrainin, mac)
+            with self.stats.timer('mapping'):
+                _packet = self.build_packet(data, rain, station)
+            return _packet
+        except Exception as e:
+            log.error(DRIVER_NAME + " driver could not build a packet.")
+            log.error("Error caught was: %s", e)
+            return None
 
-            # build the packet data
+    def gen_packets(self, packets):
+        """Yields (MAC, data, packet) loop packets to weewx, recording each one as sent."""
+        for mac, data, _packet in packets:
             try:
-                log.debug("============Starting Packet Build============")
-                if error_occured:
-                    error_occured = False
-                    raise Exception('Previous error occured, skipping packet build.')
-
-                dailyrainin = 0.0
-                # Check the API for dai
-                if 'dailyrainin' in data.keys():
-                    dailyrainin = self.get_float(data['dailyrainin'])
-
-                # Create the initial packet dict
-                _packet = {
-                    'dateTime': current_observation,
-                    'usUnits': weewx.US,
-                    'rain': self.check_rain_rate(dailyrainin),
-                }
-
-                # Key is weewx packet, value is Ambient value
-                # Loop the values in the mapping and look for actual values in the API data
-                mapping = self.get_packet_mapping()
-                for key, value in mapping.items():
-                    is_battery = value.startswith('batt')
-                    if value in data:
-                        log.debug("Setting Weewx value: '%s' to: %s using Ambient field: '%s'" %
-                                  (key, str(data[value]), value))
-                        if is_battery:
-                            _packet[key] = self.get_battery_status(data[value])
-                        else:
-                            _packet[key] = self.get_float(data[value])
-                    else:
-                        if self.aw_debug == 1:
-                            log.info("Weewx value: '%s' not found in AW JSON packet." % (key))
-
-                self.print_dict(_packet)
-                log.debug("============Completed Packet Build============")
-                yield _packet
+                self.last_dateutc[mac] = data["dateutc"]
+                self.stats.increment('packets')
+                self.stats.gauge('observation_age_seconds', time.time() - data["dateutc"] / 1000.0)
+                self.last_packet_ts = max(_packet['dateTime'], self.last_packet_ts or 0)
+                with self.stats.timer('accept'):
+                    yield _packet
                 log.info("loopPacket Accepted")
             except Exception as e:
-                syslog.syslog(DRIVER_NAME + " driver had an error sending data to weewx.")
                 log.error(DRIVER_NAME + " driver had an error sending data to weewx.")
-                syslog.syslog("Error caught was: %s" % e)
-                log.error("Error caught was: %s" % e)
+                log.error("Error caught was: %s", e)
+
+    def build_packets(self, observations):
+        """Builds the loop packets of (Station, MAC, data) observations, returning a list of (MAC, data, packet)."""
+        packets = []
+        dump = self.debug_sample()
+        for station, mac, data in observations:
+            _packet = self.build_observation_packet(station, mac, data)
+            if _packet is not None:
+                if station.derived is not None:
+                    with self.stats.timer('derived'):
+                        station.derived.add(_packet)
+                if dump:
+                    self.dump_observation(mac, data, _packet, station)
+                packets.append((mac, data, _packet))
+        return packets
+
+    async def poll_packets(self):
+        """Polls every account once, returning the new loop packets, oldest first, as a list of (MAC, data, packet).
+
+        Each account's fetch runs on the poller's thread pool with the account's timeout plus
+        the longest it may wait for its rate limiter slot, so that wait is not taken for an
+        outage.  With several accounts the poll waits at most merge_wait seconds for them; an
+        account still in flight is left to finish and its packets join a later poll, which
+        sends them unless weewx has closed their archive period by then."""
+        for account in self.accounts:
+            if account.fetch is None:
+                account.fetch = self.poller.loop.create_task(
+                    self.poller.call(self.fetch_readings, account, timeout=account.timeout + account.max_wait))
+        await asyncio.wait([account.fetch for account in self.accounts],
+                           timeout=self.merge_wait if len(self.accounts) > 1 else None)
+        packets = []
+        for account in self.accounts:
+            if account.fetch.done():
+                fetch, account.fetch = account.fetch, None
+                packets.extend(await self.account_packets(account, fetch))
+        return self.merge_packets(packets)
+
+    async def account_packets(self, account, fetch):
+        """Returns the new loop packets of an account's finished fetch, as a list of (MAC, data, packet).
+
+        Errors are logged and give an empty list.  The first account paces the polling, so
+        its results and errors are passed to the scheduler and the offline queue."""
+        primary = account is self.accounts[0]
+        where = '' if primary else ' for account %s' % account.name
+        try:
+            # get the last report dict for each station
+            readings = fetch.result()
+            with self.stats.timer('station_search'):
+                selected = self.select_stations(readings, account=account)
+            if primary:
+                # Convert the epoch to the format weewx wants, the first station paces the polling.
+                self.scheduler.observed(self.convert_epoch_ms_to_sec(selected[0][2]["dateutc"]))
+                for station, mac, data in selected:
+                    if station is self.stations[0]:
+                        self.primary_mac = mac
+                        await self.recover_outage(data)
+            observations = self.new_observations(selected)
+
+        except (asyncio.TimeoutError,) + self.connection_errors as e:
+            log.error(DRIVER_NAME + " driver could not reach the API%s, the connection will be recreated.", where)
+            log.error("Error caught was: %s",
+                      str(e) or 'no response within %s seconds' % (account.timeout + account.max_wait))
+            self.reset_api(account)
+            self.stats.increment('timeouts' if isinstance(e, asyncio.TimeoutError) else 'connection_errors')
+            if primary:
+                self.scheduler.failed()
+                self.note_outage()
+            return []
+        except RateLimited as e:
+            log.info("%s%s, skipping this poll", e, where)
+            self.stats.increment('rate_limited')
+            if primary:
+                self.scheduler.failed(429, e.wait)
+            return []
+        except Exception as e:
+            log.error(DRIVER_NAME + " driver encountered an error%s.", where)
+            log.error("Error caught was: %s", e)
+            status, retry_after = self.get_api_status(account)
+            self.stats.increment('rate_limited' if status == 429 else 'errors')
+            if primary:
+                self.scheduler.failed(status, retry_after)
+                self.note_outage()
+            return []
+
+        # build the packet data
+        return self.build_packets(observations)
+
+    def merge_packets(self, packets):
+        """Orders the (MAC, data, packet) of a poll by time, dropping any from an archive period already closed.
+
+        weewx's accumulator takes packets in any order within the current archive period,
+        but a packet from an earlier period would open an accumulator in the past.  So a
+        late packet, such as one of an account that missed the previous poll, is only
+        dropped if it falls before the period of the last packet sent."""
+        packets.sort(key=lambda item: item[2]['dateTime'])
+        if self.last_packet_ts is None:
+            return packets
+        period_start = weeutil.weeutil.startOfInterval(self.last_packet_ts, self.archive_period)
+        merged = [item for item in packets if item[2]['dateTime'] > period_start]
+        if len(merged) < len(packets):
+            self.stats.increment('late_packets', len(packets) - len(merged))
+            log.info("Dropped %d observations from an archive period weewx has closed", len(packets) - len(merged))
+        return merged
+
+    def gen_realtime_packets(self):
+        """Yields loop packets from the realtime API as the stations upload.
+
+        Returns when the subscription cannot be made or no data arrives for
+        realtime_timeout seconds, so the caller can fall back to polling."""
+        subscription = RealtimeSubscription(self.realtime_url, self.api_key, self.api_app_key,
+                                            timeout=self.api_timeout)
+        try:
+            subscription.connect()
+        except Exception as e:
+            log.error(DRIVER_NAME + " driver could not subscribe to the realtime API.")
+            log.error("Error caught was: %s", e)
+            subscription.close()
+            return
+        log.info("Subscribed to the realtime API at %s", self.realtime_url)
+        try:
+            while True:
+                try:
+                    mac, data = subscription.get(self.realtime_timeout)
+                except queue.Empty:
+                    log.error("No realtime data for %d seconds.", self.realtime_timeout)
+                    return
+                # Without a configured MAC only the first station of the account is used
+                if not self.use_station_mac and mac != subscription.first_mac:
+                    continue
+                selected = self.select_stations([(mac, data)], fallback=False)
+                for _packet in self.gen_packets(self.build_packets(self.new_observations(selected))):
+                    yield _packet
+        finally:
+            subscription.close()
+
+    def genLoopPackets(self):
+        log.debug("calling: genLoopPackets")
+
+        if self.mode == 'realtime':
+            for _packet in self.gen_realtime_packets():
+                yield _packet
+            log.error("Realtime mode failed, falling back to polling the REST API.")
+
+        # The sync side of the asyncio core, weewx needs a generator
+        while True:
+            # Query the API to get the latest reading.
+            packets = self.poller.run(self.poll_packets())
+            for _packet in self.gen_packets(packets):
+                yield _packet
+
+            self.write_stats()
 
             # Sleepy Time
-            log.debug("Going to sleep")
-            time.sleep(self.loop_interval)
-            log.debug("Mom, I'm up!")
+            if self.poller.run(self.poller.sleep(self.scheduler.remaining())):
+                log.info("Driver stopping, leaving the loop")
+                return
 
 
 if __name__ == "__main__":
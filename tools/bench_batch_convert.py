@@ -0,0 +1,203 @@
+""" Benchmark of a column-at-a-time packet build against the driver's per-packet build.
+
+    The driver builds every packet, history records included, one observation at
+    a time with build_packet().  This script keeps the batch converter that was
+    tried instead: it gathers each mapped Ambient field into a column across the
+    observations, casts it to float (or flips it to a battery status) in one
+    operation on NumPy or the array module, and zips the packets back together.
+
+    Both paths build the same synthetic records, alternating between two
+    stations so every other packet gets the second station's prefix, and the
+    script checks they give the same packets.  It prints the time per packet of
+    build_packet() and the speedup of each batch backend.  The batch is slower
+    at every size, so the driver does not use it:
+
+      records   build_packet us   numpy   array
+            8              6.43   0.23x   0.24x
+           32              6.48   0.42x   0.42x
+          100              6.56   0.52x   0.51x
+          288              6.51   0.57x   0.56x
+         1000              6.66   0.58x   0.57x
+         2016              6.79   0.58x   0.55x
+        10000              7.12   0.51x   0.54x
+
+    Run from the repository root with weewx installed (NumPy is optional):
+
+        python tools/bench_batch_convert.py [sizes ...]
+
+"""
+
+import array
+import logging
+import operator
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import weewx  # noqa: E402
+
+from bench_packet_build import SAMPLE  # noqa: E402
+from user.ambientweatherapi import AmbientWeatherAPI  # noqa: E402
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MACS = ('00:0E:C6:00:00:01', '00:0E:C6:00:00:02')
+
+
+class BatchConverter(object):
+    """Converts a list of Ambient observations into weewx packets a column at a time.
+
+    Gives the same packets as build_packet() with US units, for a driver without
+    derived observations."""
+
+    # Marks an Ambient field missing from an observation, None is a valid value
+    MISSING = object()
+
+    def __init__(self, packet_plan, use_meteobridge, use_numpy=True):
+        self.use_numpy = use_numpy and numpy is not None
+        self.low, self.ok = (0.0, 1.0) if use_meteobridge else (1.0, 0.0)
+        # Ambient field -> (weewx keys, battery status or not), in plan order
+        columns = {}
+        for key, field, convert in packet_plan:
+            columns.setdefault(field, ([], field.startswith('batt')))[0].append(key)
+        self.columns = tuple((field, tuple(keys), battery) for field, (keys, battery) in columns.items())
+
+    def floats(self, values):
+        """Casts a column to floats, raising TypeError if a value is None or MISSING."""
+        if self.use_numpy:
+            if None in values:
+                raise TypeError('None in column')
+            return numpy.array(values, dtype=numpy.float64).tolist()
+        return array.array('d', map(float, values)).tolist()
+
+    def battery_status(self, values):
+        """Flips a column of battery values to weewx statuses, raising TypeError if a value is None or MISSING."""
+        if self.use_numpy:
+            if None in values:
+                raise TypeError('None in column')
+            return numpy.where(numpy.array(values, dtype=numpy.float64) <= 0, self.low, self.ok).tolist()
+        return [self.low if value <= 0 else self.ok for value in values]
+
+    def convert_column(self, values, battery):
+        """Converts a column, leaving None and MISSING alone."""
+        convert = self.battery_status if battery else self.floats
+        try:
+            return convert(values)
+        except TypeError:
+            pass
+        known = [index for index, value in enumerate(values) if value is not None and value is not self.MISSING]
+        converted = list(values)
+        for index, value in zip(known, convert([values[index] for index in known])):
+            converted[index] = value
+        return converted
+
+    def convert(self, records, rains, prefixes):
+        """Returns the packets of a list of observations, their interval rains and station prefixes."""
+        if self.use_numpy:
+            times = (numpy.array([data['dateutc'] for data in records], dtype=numpy.float64) / 1000).tolist()
+        else:
+            times = [epoch_ms / 1000 for epoch_ms in array.array('d', [data['dateutc'] for data in records])]
+        keys = ['dateTime', 'usUnits', 'rain']
+        columns = [times, [weewx.US] * len(records), rains]
+        # Rows lacking a field, which is left out of their packet as build_packet() does
+        partial = set()
+        for field, field_keys, battery in self.columns:
+            try:
+                values = list(map(operator.itemgetter(field), records))
+            except KeyError:
+                values = [data.get(field, self.MISSING) for data in records]
+                if all(value is self.MISSING for value in values):
+                    continue
+                partial.update(index for index, value in enumerate(values) if value is self.MISSING)
+            converted = self.convert_column(values, battery)
+            keys.extend(field_keys)
+            columns.extend([converted] * len(field_keys))
+
+        keys_by_prefix = dict((prefix, keys[:2] + [prefix + key for key in keys[2:]]) for prefix in set(prefixes))
+        packets = [dict(zip(keys_by_prefix[prefix], row)) for prefix, row in zip(prefixes, zip(*columns))]
+        for index in partial:
+            _packet = packets[index]
+            for key in [key for key, value in _packet.items() if value is self.MISSING]:
+                del _packet[key]
+        return packets
+
+
+def make_records(count):
+    """Returns count five minute records based on SAMPLE, with varied values and the odd gap."""
+    rng = random.Random(count)
+    records = []
+    for index in range(count):
+        data = dict(SAMPLE)
+        data['dateutc'] = SAMPLE['dateutc'] + index * 300000
+        data['tempf'] = round(rng.uniform(-20, 100), 1)
+        data['batt1'] = rng.choice((0, 1))
+        if index % 17 == 0:
+            del data['humidity2']
+        if index % 23 == 0:
+            data['solarradiation'] = None
+        records.append(data)
+    return records
+
+
+def best_of(func, repeat):
+    """Returns the best wall time of repeat calls of func, and its result."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [8, 32, 100, 288, 1000, 2016, 10000]
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix='awbatch')
+    try:
+        driver = AmbientWeatherAPI(api_key='bench', api_app_key='bench', station_mac=', '.join(MACS),
+                                   packet_filter='none', derived_observations='false',
+                                   state_file=os.path.join(workdir, 'state.json'),
+                                   queue_file=os.path.join(workdir, 'queue.jsonl'))
+        converters = [('array', BatchConverter(driver.packet_plan, driver.use_meteobridge, use_numpy=False))]
+        if numpy is not None:
+            converters.insert(0, ('numpy', BatchConverter(driver.packet_plan, driver.use_meteobridge)))
+        else:
+            print('NumPy is not installed, only the array backend is benchmarked')
+
+        print('%8s %16s %s' % ('records', 'build_packet us', ' '.join('%8s' % name for name, _ in converters)))
+        failed = False
+        for size in sizes:
+            records = make_records(size)
+            rains = [0.01 * (index % 3) for index in range(size)]
+            stations = [driver.stations[index % 2] for index in range(size)]
+            prefixes = [station.prefix for station in stations]
+            repeat = max(3, 100000 // size)
+            packet_time, expected = best_of(
+                lambda: [driver.build_packet(data, rain, station)
+                         for data, rain, station in zip(records, rains, stations)], repeat)
+            speedups = []
+            for name, converter in converters:
+                batch_time, packets = best_of(lambda: converter.convert(records, rains, prefixes), repeat)
+                if packets != expected:
+                    print('FAILED: %s packets differ from build_packet()' % name)
+                    failed = True
+                speedups.append('%7.2fx' % (packet_time / batch_time))
+            print('%8d %16.2f %s' % (size, packet_time / size * 1e6, ' '.join(speedups)))
+        driver.closePort()
+    finally:
+        shutil.rmtree(workdir)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+""" Micro-benchmark for the loop packet build.
+
+    Compares the per-packet cost of the original build (rebuild the mapping dict,
+    test every Ambient field for the battery prefix and format a debug string
+    per field) with the packet plan compiled at driver startup.
+
+    Run from the repository root with weewx and ambient_api installed:
+
+        python tools/bench_packet_build.py [iterations]
+
+"""
+
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import weewx  # noqa: E402
+from user.ambientweatherapi import AmbientWeatherAPI  # noqa: E402
+
+log = logging.getLogger('bench')
+
+SAMPLE = {
+    'dateutc': 1700000000000, 'tempinf': 71.2, 'humidityin': 38, 'baromrelin': 30.01, 'baromabsin': 29.12,
+    'tempf': 45.5, 'battout': 1, 'humidity': 81, 'winddir': 221, 'windspeedmph': 3.4, 'windgustmph': 6.9,
+    'maxdailygust': 12.5, 'hourlyrainin': 0.0, 'eventrainin': 0.0, 'dailyrainin': 0.12, 'weeklyrainin': 0.4,
+    'monthlyrainin': 1.2, 'totalrainin': 20.1, 'solarradiation': 122.4, 'uv': 1, 'temp1f': 68.0,
+    'humidity1': 40, 'batt1': 1, 'temp2f': 38.1, 'humidity2': 90, 'batt2': 0, 'soilhum1': 33,
+    'soiltemp1f': 50.2, 'pm25': 8.0, 'aqi_pm25': 33, 'feelsLike': 43.0, 'dewPoint': 40.0,
+    'feelsLikein': 70.0, 'dewPointin': 44.0, 'feelsLike1': 67.0, 'dewPoint1': 42.0, 'feelsLike2': 38.1,
+    'dewPoint2': 35.5, 'lastRain': '2023-11-14T10:00:00.000Z', 'tz': 'America/New_York',
+}
+
+
+def get_float(value):
+    """Checks if a value is not, if not it performs a converstion to a float()"""
+    log.debug("calling: get_float")
+    if value is None:
+        return value
+    else:
+        return float(value)
+
+
+def get_battery_status(driver, value):
+    """Converts the AM API battery status to somthing weewx likes."""
+    if value is None:
+        return None
+    if (value <= 0):
+        if driver.use_meteobridge:
+            log.debug("use_meteobridge flip bit to 0.0")
+            return 0.0
+        else:
+            return 1.0
+    else:
+        if driver.use_meteobridge:
+            log.debug("use_meteobridge flip bit to 1.0")
+            return 1.0
+        else:
+            return 0.0
+
+
+def legacy_build(driver, data):
+    """The packet build as it was before the packet plan, with the driver's old per-value getters."""
+    _packet = {
+        'dateTime': driver.convert_epoch_ms_to_sec(data["dateutc"]),
+        'usUnits': weewx.US,
+        'rain': 0.0,
+    }
+    mapping = driver.get_packet_mapping()
+    for key, value in mapping.items():
+        is_battery = value.startswith('batt')
+        if value in data:
+            log.debug("Setting Weewx value: '%s' to: %s using Ambient field: '%s'" %
+                      (key, str(data[value]), value))
+            if is_battery:
+                _packet[key] = get_battery_status(driver, data[value])
+            else:
+                _packet[key] = get_float(data[value])
+    return _packet
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    logging.basicConfig(level=logging.WARNING)
+    # The legacy map still sends rainRate, which the driver now works out with the derived observations
+    driver = AmbientWeatherAPI(api_key='bench', api_app_key='bench', packet_filter='none',
+                               derived_observations='false')
+
+    if legacy_build(driver, SAMPLE) != driver.build_packet(SAMPLE, 0.0):
+        print('WARNING: legacy and planned packets differ')
+
+    for name, func in (('legacy', lambda: legacy_build(driver, SAMPLE)),
+                       ('planned', lambda: driver.build_packet(SAMPLE, 0.0))):
+        best = min(timeit.repeat(func, number=iterations, repeat=5))
+        print('%-8s %8.2f us/packet' % (name, best / iterations * 1e6))
+
+
+if __name__ == '__main__':
+    main()
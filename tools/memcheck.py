@@ -0,0 +1,125 @@
+""" Memory check of the steady-state polling loop.
+
+    Runs the driver's poll loop (the asyncio poll, station selection, rain
+    correction, packet build, derived observations and the hand-off to weewx)
+    for many simulated loops against an in-memory API client, with no network
+    or sleeps, under tracemalloc.  After a warm-up it compares the memory still
+    allocated at the end with that at the start and lists the lines that grew,
+    and exits with status 1 if the growth is over the limit.  It also reports the
+    average peak of short-lived allocations within a loop.
+
+    Run from the repository root with weewx installed:
+
+        python tools/memcheck.py [--loops N] [--stations N] [--limit BYTES]
+
+"""
+
+import argparse
+import gc
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+from bench_packet_build import SAMPLE  # noqa: E402
+from user.ambientweatherapi import AmbientWeatherAPI  # noqa: E402
+
+
+class FakeFetcher(object):
+    """Stands in for the builtin API client, each call returns the next upload of every station."""
+
+    def __init__(self, macs):
+        self.macs = macs
+        self.dateutc = SAMPLE['dateutc']
+        self.calls = 0
+
+    def get_readings(self, macs=None):
+        """Returns a list of (MAC, last data), one upload_interval on from the previous call."""
+        self.calls += 1
+        self.dateutc += 60000
+        readings = []
+        for index, mac in enumerate(self.macs):
+            data = dict(SAMPLE)
+            data['dateutc'] = self.dateutc
+            data['tempf'] = 40 + (self.calls + index) % 20
+            # Some rain every so often, reset every day like dailyrainin
+            data['dailyrainin'] = 0.01 * ((self.calls % 1440) // 30)
+            readings.append((mac, data))
+        return readings
+
+
+def run_loops(driver, loops):
+    """Runs loops polls through the driver, handing every packet on like genLoopPackets() does.
+
+    Returns the number of packets and the sum of the allocation peaks within each loop."""
+    packets = 0
+    churn = 0
+    for _ in range(loops):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        for _packet in driver.gen_packets(driver.poller.run(driver.poll_packets())):
+            packets += 1
+        churn += tracemalloc.get_traced_memory()[1] - before
+    return packets, churn
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that the polling loop does not grow its memory.')
+    parser.add_argument('--loops', type=int, default=100000, help='loops to run after the warm-up (default 100000)')
+    parser.add_argument('--warmup', type=int, default=2000, help='loops to run before measuring (default 2000)')
+    parser.add_argument('--stations', type=int, default=1, help='stations on the account (default 1)')
+    parser.add_argument('--limit', type=int, default=64 * 1024,
+                        help='largest growth in bytes that passes (default 65536)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    macs = ['00:0E:C6:00:00:%02X' % (index + 1) for index in range(args.stations)]
+    workdir = tempfile.mkdtemp(prefix='awmemcheck')
+    try:
+        driver = AmbientWeatherAPI(api_key='memcheck', api_app_key='memcheck', api_backend='builtin',
+                                   station_mac=', '.join(macs), packet_filter='none', rate_limit='false',
+                                   response_cache='false', latitude='40.0', longitude='-75.0', altitude='100',
+                                   state_file=os.path.join(workdir, 'state.json'), state_flush_interval='3600',
+                                   queue_file=os.path.join(workdir, 'queue.jsonl'))
+        driver.scheduler.min_spacing = 0
+        account = driver.accounts[0]
+        account.api = FakeFetcher(macs)
+
+        tracemalloc.start()
+        run_loops(driver, args.warmup)
+        gc.collect()
+        before = tracemalloc.take_snapshot()
+        start = time.perf_counter()
+        packets, churn = run_loops(driver, args.loops)
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        driver.closePort()
+    finally:
+        shutil.rmtree(workdir)
+
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    before = before.filter_traces(filters)
+    after = after.filter_traces(filters)
+    growth = sum(stat.size for stat in after.statistics('filename')) - \
+        sum(stat.size for stat in before.statistics('filename'))
+    print('%d loops, %d packets in %.1f s: memory grew %d bytes (%.3f bytes/loop), limit %d' %
+          (args.loops, packets, elapsed, growth, growth / float(args.loops), args.limit))
+    print('peak allocation within a loop: %.0f bytes' % (churn / float(args.loops)))
+    for stat in after.compare_to(before, 'lineno')[:10]:
+        if stat.size_diff > 0:
+            print('  %s' % stat)
+    if growth > args.limit:
+        print('FAILED: memory grew by more than %d bytes' % args.limit)
+        sys.exit(1)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+""" Local stand-in for the Ambient Weather realtime API.
+
+    A Socket.IO server that answers subscribe with subscribed, listing every
+    station with its last data, and pushes a data event to the subscribed
+    clients each time a station "uploads", every --upload-interval seconds.
+    Observations are the synthetic ones of tools/mock_server.py.  Like the
+    real service it forgets a subscription with its connection, and
+    --drop-every drops every connection that often, so a client has to
+    subscribe again after it reconnects or it stops getting data.
+
+    Needs python-socketio and aiohttp.  Point the driver at it in weewx.conf:
+
+        mode = realtime
+        realtime_url = http://localhost:8081
+
+    and run it from the repository root:
+
+        python tools/mock_realtime_server.py [--port 8081] [--mac MAC ...] [--upload-interval 60]
+                                             [--drop-every SECONDS]
+
+"""
+
+import argparse
+import asyncio
+import math
+import time
+
+import socketio
+from aiohttp import web
+
+from mock_server import observation
+
+
+class MockRealtime(object):
+    """State of the mock realtime API: stations and the subscribed connections."""
+
+    def __init__(self, server, macs, upload_interval=60):
+        self.server = server
+        self.macs = macs
+        self.upload_interval = upload_interval
+        self.subscribers = set()
+        server.on('connect', self.on_connect)
+        server.on('subscribe', self.on_subscribe)
+        server.on('disconnect', self.on_disconnect)
+
+    def device(self, mac, ts):
+        """Returns the realtime data event of a station at ts (epoch sec), macAddress included."""
+        data = observation(mac, ts)
+        data['macAddress'] = mac
+        return data
+
+    async def on_connect(self, sid, environ):
+        query = environ.get('QUERY_STRING', '')
+        if 'applicationKey=' not in query:
+            print('%s refused, no applicationKey' % sid)
+            return False
+        print('%s connected' % sid)
+
+    async def on_subscribe(self, sid, message):
+        if not message or not message.get('apiKeys'):
+            return
+        self.subscribers.add(sid)
+        ts = math.floor(time.time() / self.upload_interval) * self.upload_interval
+        devices = [{'macAddress': mac, 'lastData': self.device(mac, ts),
+                    'info': {'name': 'Mock %d' % (index + 1), 'location': 'Localhost'}}
+                   for index, mac in enumerate(self.macs)]
+        print('%s subscribed' % sid)
+        await self.server.emit('subscribed', {'devices': devices}, to=sid)
+
+    async def on_disconnect(self, sid, *args):
+        self.subscribers.discard(sid)
+        print('%s disconnected' % sid)
+
+    async def upload(self):
+        """Pushes a data event of every station to the subscribers, on every upload_interval boundary."""
+        while True:
+            now = time.time()
+            ts = (math.floor(now / self.upload_interval) + 1) * self.upload_interval
+            await asyncio.sleep(ts - now)
+            for mac in self.macs:
+                for sid in list(self.subscribers):
+                    await self.server.emit('data', self.device(mac, ts), to=sid)
+            print('upload at %d sent to %d subscriber(s)' % (ts, len(self.subscribers)))
+
+
+async def serve(mock, port, drop_every=None):
+    """Serves the mock, restarting the listener every drop_every seconds to drop every connection.
+
+    A restart closes the transports without a Socket.IO disconnect, so clients reconnect as they
+    would after a network fault, and the server has forgotten their subscriptions."""
+    uploads = asyncio.ensure_future(mock.upload())
+    try:
+        while True:
+            app = web.Application()
+            mock.server.attach(app)
+            runner = web.AppRunner(app, shutdown_timeout=0.5)
+            await runner.setup()
+            await web.TCPSite(runner, '127.0.0.1', port).start()
+            if drop_every is None:
+                await asyncio.Event().wait()
+            await asyncio.sleep(drop_every)
+            print('dropping %d connection(s)' % len(mock.subscribers))
+            await runner.cleanup()
+    finally:
+        uploads.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the Ambient Weather realtime API.')
+    parser.add_argument('--port', type=int, default=8081, help='port to listen on (default 8081)')
+    parser.add_argument('--mac', action='append', default=[], help='station MAC, may be repeated')
+    parser.add_argument('--upload-interval', type=float, default=60, help='seconds between uploads (default 60)')
+    parser.add_argument('--drop-every', type=float, default=None, metavar='SECONDS',
+                        help='drop every connection this often')
+    args = parser.parse_args()
+
+    macs = [mac.upper() for mac in args.mac] or ['00:0E:C6:00:00:01']
+    mock = MockRealtime(socketio.AsyncServer(async_mode='aiohttp'), macs, args.upload_interval)
+    print('Serving %s on http://127.0.0.1:%d' % (', '.join(macs), args.port))
+    try:
+        asyncio.run(serve(mock, args.port, args.drop_every))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+""" Local stand-in for the Ambient Weather REST API.
+
+    Serves /v1/devices and /v1/devices/<mac> with synthetic observations, so the
+    driver's polling, response cache, backfill and error handling can be tried
+    offline.  Each station "uploads" every --upload-interval seconds; the history
+    endpoint returns five minute records, newest first, paged with limit and
+    endDate like the real one.  Responses carry an ETag and a matching
+    If-None-Match gets 304 Not Modified.  Errors can be injected: random 500s,
+    429s for API keys polling faster than --key-rate, and an outage window.
+
+    Point the driver at it in weewx.conf:
+
+        api_url = http://localhost:8080/v1
+
+    and run it from the repository root:
+
+        python tools/mock_server.py [--port 8080] [--mac MAC ...] [--upload-interval 60]
+                                    [--fail-rate 0.1] [--key-rate 1] [--outage START:LENGTH]
+
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+HISTORY_INTERVAL = 300
+
+DEVICE_PATH = re.compile(r'^/v1/devices/([0-9A-Fa-f:]+)$')
+
+
+def observation(mac, ts):
+    """Returns the synthetic lastData of a station at ts (epoch sec), the same every time it is asked for."""
+    seed = int(hashlib.sha256(mac.encode('utf-8')).hexdigest()[:4], 16)
+    day = 2 * math.pi * (ts % 86400) / 86400.0
+    tempf = round(50 + 15 * math.sin(day - 2) + seed % 10, 1)
+    humidity = int(70 - 20 * math.sin(day - 2))
+    return {
+        'dateutc': int(ts) * 1000,
+        'tempf': tempf,
+        'humidity': humidity,
+        'dewPoint': round(tempf - (100 - humidity) / 5.0 * 1.8, 1),
+        'feelsLike': tempf,
+        'tempinf': 70.1,
+        'humidityin': 40,
+        'baromrelin': round(30.0 + 0.2 * math.sin(day), 3),
+        'baromabsin': round(29.2 + 0.2 * math.sin(day), 3),
+        'windspeedmph': round(abs(6 * math.sin(ts / 900.0)), 1),
+        'windgustmph': round(abs(9 * math.sin(ts / 900.0)), 1),
+        'winddir': int(ts / 60) % 360,
+        'maxdailygust': 12.3,
+        'solarradiation': round(max(0.0, 800 * math.sin(day - math.pi / 2)), 1),
+        'uv': max(0, int(8 * math.sin(day - math.pi / 2))),
+        # A hundredth of an inch an hour, starting again at midnight UTC
+        'dailyrainin': round(0.01 * int((ts % 86400) / 3600), 2),
+        'hourlyrainin': 0.01,
+        'battout': 1,
+        'tz': 'Etc/UTC',
+    }
+
+
+class MockAmbient(object):
+    """State of the mock API: stations, upload cadence and injected errors."""
+
+    def __init__(self, macs, upload_interval=60, fail_rate=0.0, key_rate=None, outage=None, clock=time.time):
+        self.macs = macs
+        self.upload_interval = upload_interval
+        self.fail_rate = fail_rate
+        self.key_rate = key_rate
+        self.clock = clock
+        self.started = clock()
+        self.outage = outage
+        self.last_request = {}
+        self.lock = threading.Lock()
+
+    def last_upload(self):
+        """Returns the time (epoch sec) of the latest upload."""
+        return math.floor(self.clock() / self.upload_interval) * self.upload_interval
+
+    def error(self, api_key):
+        """Returns the (status, headers) of an injected error for this request, or None."""
+        now = self.clock()
+        if self.outage is not None:
+            start, length = self.outage
+            if start <= now - self.started < start + length:
+                return 503, {}
+        if self.key_rate:
+            with self.lock:
+                last = self.last_request.get(api_key)
+                self.last_request[api_key] = now
+            if last is not None and now - last < 1.0 / self.key_rate:
+                return 429, {'Retry-After': '%d' % math.ceil(1.0 / self.key_rate)}
+        if random.random() < self.fail_rate:
+            return 500, {}
+        return None
+
+    def devices(self):
+        """Returns the /devices payload, macAddress first in each device as the real API sends it."""
+        ts = self.last_upload()
+        return [{'macAddress': mac, 'lastData': observation(mac, ts),
+                 'info': {'name': 'Mock %d' % (index + 1), 'location': 'Localhost'}}
+                for index, mac in enumerate(self.macs)]
+
+    def history(self, mac, limit=288, end_date=None):
+        """Returns up to limit five minute records of a station, newest first, ending at end_date (epoch ms)."""
+        end = self.clock() if end_date is None else min(self.clock(), end_date / 1000.0)
+        newest = math.floor(end / HISTORY_INTERVAL) * HISTORY_INTERVAL
+        return [observation(mac, newest - index * HISTORY_INTERVAL) for index in range(max(0, min(limit, 288)))]
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answers the Ambient REST endpoints from the server's MockAmbient."""
+
+    def do_GET(self):
+        mock = self.server.mock
+        url = urlparse(self.path)
+        query = dict((name, values[-1]) for name, values in parse_qs(url.query).items())
+        if not query.get('apiKey') or not query.get('applicationKey'):
+            return self.send_json(401, {'error': 'unauthorized'})
+        error = mock.error(query['apiKey'])
+        if error is not None:
+            status, headers = error
+            return self.send_json(status, {'error': 'injected %d' % status}, headers)
+        if url.path == '/v1/devices':
+            return self.send_json(200, mock.devices())
+        match = DEVICE_PATH.match(url.path)
+        if match is None:
+            return self.send_json(404, {'error': 'not found'})
+        mac = match.group(1).upper()
+        if mac not in mock.macs:
+            return self.send_json(404, {'error': 'unknown device'})
+        try:
+            limit = int(query.get('limit', 288))
+            end_date = int(query['endDate']) if 'endDate' in query else None
+        except ValueError:
+            return self.send_json(400, {'error': 'bad parameter'})
+        return self.send_json(200, mock.history(mac, limit, end_date))
+
+    def send_json(self, status, payload, headers=None):
+        """Sends payload as JSON with an ETag, or 304 if the client already has it."""
+        body = json.dumps(payload).encode('utf-8')
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 200:
+            self.send_header('ETag', etag)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def parse_outage(value):
+    """Parses START:LENGTH (seconds after startup) into a tuple of floats."""
+    start, length = value.split(':', 1)
+    return float(start), float(length)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the Ambient Weather REST API.')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default 8080)')
+    parser.add_argument('--mac', action='append', default=[], help='station MAC, may be repeated')
+    parser.add_argument('--upload-interval', type=float, default=60, help='seconds between uploads (default 60)')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of requests answered with 500')
+    parser.add_argument('--key-rate', type=float, default=None,
+                        help='requests per second allowed per API key, faster ones get 429')
+    parser.add_argument('--outage', type=parse_outage, default=None, metavar='START:LENGTH',
+                        help='answer 503 for LENGTH seconds, START seconds after startup')
+    args = parser.parse_args()
+
+    macs = [mac.upper() for mac in args.mac] or ['00:0E:C6:00:00:01']
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    server.mock = MockAmbient(macs, args.upload_interval, args.fail_rate, args.key_rate, args.outage)
+    print('Serving %s on http://127.0.0.1:%d/v1' % (', '.join(macs), args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+""" Checks of the asyncio polling core against a fake transport.
+
+    Swaps each account's pooled HTTP client for a fake one that answers the
+    /devices call from memory after a set delay, with no network, then checks
+    that:
+
+      - a fetch slower than api_timeout times out on time, is counted as a
+        timeout, and drops the client, so the next poll opens a fresh one;
+      - the poll after that gets the station's packet again;
+      - stop() from another thread cuts genLoopPackets()'s sleep short;
+      - a sleep started after stop() returns at once;
+      - the packets of a second account slower than merge_wait reach weewx a
+        poll late, as long as weewx's archive period is still open, and are
+        dropped once it is closed.
+
+    Exits with status 1 if a check fails.  Run from the repository root with
+    weewx installed:
+
+        python tools/poller_check.py [--timeout SECONDS]
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import weeutil.weeutil  # noqa: E402
+
+from bench_packet_build import SAMPLE  # noqa: E402
+from user.ambientweatherapi import AmbientFetcher, AmbientWeatherAPI  # noqa: E402
+
+MAC = '00:0E:C6:00:00:01'
+SECOND_MAC = '00:0E:C6:00:00:02'
+
+
+class FakeResponse(object):
+    """The parts of a requests response the driver reads."""
+
+    def __init__(self, payload):
+        self.status_code = 200
+        self.headers = {}
+        self.text = json.dumps(payload)
+        self.content = self.text.encode('utf-8')
+
+
+class FakeTransport(object):
+    """Stands in for AmbientHTTPClient, each get() returns the next upload after delay seconds."""
+
+    def __init__(self, delay=0.0, mac=MAC, dateutc=SAMPLE['dateutc']):
+        self.delay = delay
+        self.mac = mac
+        self.dateutc = dateutc
+        self.last_status = None
+        self.last_headers = {}
+        self.calls = 0
+        self.closed = False
+
+    def get(self, url, params=None, **kwargs):
+        self.calls += 1
+        time.sleep(self.delay)
+        self.dateutc += 60000
+        data = dict(SAMPLE)
+        data['dateutc'] = self.dateutc
+        self.last_status = 200
+        return FakeResponse([{'macAddress': self.mac, 'lastData': data}])
+
+    def close(self):
+        self.closed = True
+
+
+def use_transport(driver, transport, account=None):
+    """Points an account of the driver (the first by default) at transport, through the builtin fetcher."""
+    account = account or driver.accounts[0]
+    account.http = transport
+    account.api = AmbientFetcher(driver.api_url, account.api_key, account.app_key, transport)
+    return account
+
+
+class Checks(object):
+    """Collects the outcome of each check."""
+
+    def __init__(self):
+        self.failed = 0
+
+    def expect(self, ok, what, detail=''):
+        print('%s: %s%s' % ('ok' if ok else 'FAILED', what, ' (%s)' % detail if detail else ''))
+        if not ok:
+            self.failed += 1
+
+
+def check_slow_account(checks, workdir):
+    """Polls a fast first account and a second one that always runs past merge_wait."""
+    driver = AmbientWeatherAPI(api_key='check', api_app_key='check', api_backend='builtin', station_mac=MAC,
+                               packet_filter='none', rate_limit='false', response_cache='false',
+                               merge_wait='0.2', archive_period='300', latitude='40.0', longitude='-75.0',
+                               altitude='100', state_file=os.path.join(workdir, 'slow_state.json'),
+                               queue_file=os.path.join(workdir, 'slow_queue.jsonl'), gap_catchup='0',
+                               accounts={'second': {'api_key': 'check2', 'station_mac': SECOND_MAC}})
+    # The transports add a minute per call, so the first station uploads a minute into an archive
+    # period and on through it, the second 15 s before the first
+    start_ms = (weeutil.weeutil.startOfInterval(SAMPLE['dateutc'] / 1000, 300) + 300) * 1000
+    use_transport(driver, FakeTransport(dateutc=start_ms))
+    use_transport(driver, FakeTransport(delay=0.5, mac=SECOND_MAC, dateutc=start_ms - 15000), driver.accounts[1])
+    sent = []
+    for _ in range(4):
+        sent.extend(driver.gen_packets(driver.poller.run(driver.poll_packets())))
+        time.sleep(0.4)
+    second = [packet for packet in sent if 'second_outTemp' in packet]
+    checks.expect(len(second) >= 2, 'packets of an account slower than merge_wait reach weewx',
+                  '%d of %d sent, late_packets=%d' % (len(second), len(sent), driver.stats.counters['late_packets']))
+    period_starts = [weeutil.weeutil.startOfInterval(packet['dateTime'], 300) for packet in sent]
+    checks.expect(all(later >= earlier for earlier, later in zip(period_starts, period_starts[1:])),
+                  'no packet goes back to an archive period already left')
+
+    # A packet from before the period of the last one sent is still dropped
+    last = driver.last_packet_ts
+    late = dict(sent[-1], dateTime=weeutil.weeutil.startOfInterval(last, 300))
+    merged = driver.merge_packets([(SECOND_MAC, {}, late)])
+    checks.expect(merged == [], 'a packet from a closed archive period is dropped')
+    driver.closePort()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check timeouts and shutdown of the asyncio polling core.')
+    parser.add_argument('--timeout', type=float, default=0.5, help='api_timeout to run with (default 0.5)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    checks = Checks()
+    workdir = tempfile.mkdtemp(prefix='awpoller')
+    try:
+        driver = AmbientWeatherAPI(api_key='check', api_app_key='check', api_backend='builtin', station_mac=MAC,
+                                   packet_filter='none', rate_limit='false', response_cache='false',
+                                   api_timeout=str(args.timeout), latitude='40.0', longitude='-75.0',
+                                   altitude='100', state_file=os.path.join(workdir, 'state.json'),
+                                   queue_file=os.path.join(workdir, 'queue.jsonl'), gap_catchup='0')
+
+        # A fetch four times slower than the timeout
+        slow = FakeTransport(delay=4 * args.timeout)
+        account = use_transport(driver, slow)
+        start = time.perf_counter()
+        packets = driver.poller.run(driver.poll_packets())
+        elapsed = time.perf_counter() - start
+        checks.expect(packets == [], 'slow fetch gives no packets')
+        checks.expect(elapsed < 2 * args.timeout, 'slow fetch times out on time',
+                      '%.2f s for a %.2f s timeout' % (elapsed, args.timeout))
+        checks.expect(driver.stats.counters['timeouts'] == 1, 'timeout is counted',
+                      'timeouts=%d' % driver.stats.counters['timeouts'])
+        checks.expect(slow.closed and account.http is None and account.api is None,
+                      'client is dropped after the timeout')
+
+        # The next poll gets a fresh client
+        fast = FakeTransport()
+        fast.dateutc = slow.dateutc
+        use_transport(driver, fast)
+        packets = driver.poller.run(driver.poll_packets())
+        checks.expect(len(packets) == 1, 'next poll gets a packet', '%d packets' % len(packets))
+
+        # stop() from another thread while genLoopPackets() sleeps between polls
+        type(driver.scheduler).remaining = lambda self: 30.0
+        loop_packets = driver.genLoopPackets()
+        next(loop_packets)
+        threading.Timer(0.2, driver.poller.stop).start()
+        start = time.perf_counter()
+        stopped = next(loop_packets, None) is None
+        elapsed = time.perf_counter() - start
+        checks.expect(stopped and elapsed < 1.0, 'stop() cuts the sleep short', '%.2f s of 30 s' % elapsed)
+
+        start = time.perf_counter()
+        cut = driver.poller.run(driver.poller.sleep(30.0))
+        elapsed = time.perf_counter() - start
+        checks.expect(cut and elapsed < 0.1, 'sleep after stop() returns at once', '%.3f s' % elapsed)
+        driver.closePort()
+
+        check_slow_account(checks, workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+    if checks.failed:
+        print('FAILED: %d check(s)' % checks.failed)
+        sys.exit(1)
+    print('all checks passed')
+
+
+if __name__ == '__main__':
+    main()
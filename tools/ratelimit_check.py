@@ -0,0 +1,98 @@
+""" Check of the rate limiter shared between driver processes.
+
+    Starts several processes that each take request slots from one SharedRateLimiter
+    file as fast as it lets them, then reports the overall request rate, the
+    smallest gap between two requests and how evenly the slots were shared.  A
+    second run replays the same with a fake clock in one process, including a 429
+    with Retry-After, and checks the slots it hands out exactly.
+
+    Run from the repository root with weewx and ambient_api installed:
+
+        python tools/ratelimit_check.py [--processes N] [--requests N] [--rate R]
+
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+from user.ambientweatherapi import SharedRateLimiter  # noqa: E402
+
+
+def worker(filepath, rate, requests, results):
+    """Takes requests slots from the shared limiter, reporting the time each one was granted."""
+    limiter = SharedRateLimiter(filepath, [('api:check', rate)])
+    granted = []
+    for _ in range(requests):
+        limiter.acquire()
+        granted.append(time.time())
+    results.put((os.getpid(), granted))
+
+
+def check_processes(workdir, processes, requests, rate):
+    """Runs the worker processes against one limiter file and reports what they got."""
+    filepath = os.path.join(workdir, 'processes.json')
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=worker, args=(filepath, rate, requests, results))
+               for _ in range(processes)]
+    for process in workers:
+        process.start()
+    granted = dict(results.get() for _ in workers)
+    for process in workers:
+        process.join()
+
+    times = sorted((ts, pid) for pid, stamps in granted.items() for ts in stamps)
+    gaps = [later[0] - earlier[0] for earlier, later in zip(times, times[1:])]
+    span = times[-1][0] - times[0][0]
+    print('%d processes x %d requests at %.1f/sec:' % (processes, requests, rate))
+    print('  overall rate %.2f/sec, smallest gap %.3f sec (limit %.3f)' %
+          ((len(times) - 1) / span if span else 0, min(gaps), 1.0 / rate))
+    # Fair sharing: in the first half of the run each process should have had about half its slots
+    middle = times[len(times) // 2][0]
+    shares = sorted(sum(1 for ts in stamps if ts <= middle) for stamps in granted.values())
+    print('  slots per process in the first half of the run: %s' % ', '.join(str(share) for share in shares))
+
+
+def check_fake_clock(workdir):
+    """Checks the slots two limiters sharing a file hand out, against a fake clock."""
+    now = [1000.0]
+    filepath = os.path.join(workdir, 'fake.json')
+    buckets = [('api:check', 1.0), ('app:check', 3.0)]
+    first = SharedRateLimiter(filepath, buckets, clock=lambda: now[0])
+    second = SharedRateLimiter(filepath, buckets, clock=lambda: now[0])
+    waits = [first.reserve(), second.reserve(), first.reserve(), second.reserve()]
+    ok = waits == [0.0, 1.0, 2.0, 3.0]
+    print('fake clock, two limiters at 1/sec: waits %s %s' % (waits, 'ok' if ok else 'WRONG'))
+
+    now[0] += 10
+    second.penalize(30)
+    wait = first.reserve()
+    refused = first.reserve(max_wait=5)
+    ok = wait == 30.0 and refused is None
+    print('fake clock, after a 429 with Retry-After 30: wait %s, short reservation %s %s' %
+          (wait, refused, 'ok' if ok else 'WRONG'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the rate limiter shared between processes.')
+    parser.add_argument('--processes', type=int, default=3, help='processes sharing the limiter (default 3)')
+    parser.add_argument('--requests', type=int, default=10, help='requests per process (default 10)')
+    parser.add_argument('--rate', type=float, default=5.0, help='requests per second allowed (default 5)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='awratelimit')
+    try:
+        check_processes(workdir, args.processes, args.requests, args.rate)
+        check_fake_clock(workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
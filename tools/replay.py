@@ -0,0 +1,122 @@
+""" Replay and benchmark harness for the driver.
+
+    Feeds get_devices() captures through the same pipeline genLoopPackets() uses
+    (decode, station selection, duplicate check, rain correction, mapping, the
+    ordering of late packets and the hand-off to weewx) at full speed, with no
+    network and no sleeps, and reports packets/sec, the time per stage and the
+    memory allocated per packet.
+
+    A capture file is JSON lines, one API payload per line: either the device list
+    returned by /devices (a list of {"macAddress": ..., "lastData": {...}}) or a
+    single lastData dict.  tools/captures.jsonl is a small synthetic corpus laid out
+    like real /devices responses, not a recording of a live station.
+
+    Run from the repository root with weewx and ambient_api installed:
+
+        python tools/replay.py [--repeat N] [--option name=value ...] [captures.jsonl]
+
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+from user.ambientweatherapi import AmbientWeatherAPI  # noqa: E402
+
+DEFAULT_CAPTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'captures.jsonl')
+
+
+def load_captures(filepath):
+    """Returns the raw lines of a capture file."""
+    with open(filepath, 'r') as captures:
+        return [line for line in captures if line.strip()]
+
+
+def decode(line, offset_ms):
+    """Decodes one capture line into a list of (MAC, data), shifting dateutc by offset_ms."""
+    payload = json.loads(line)
+    if isinstance(payload, dict):
+        payload = [{'macAddress': None, 'lastData': payload}]
+    readings = []
+    for device in payload:
+        data = device.get('lastData', {})
+        if offset_ms and 'dateutc' in data:
+            data['dateutc'] += offset_ms
+        readings.append((device.get('macAddress'), data))
+    return readings
+
+
+def replay(driver, lines, repeat, measure_memory=False):
+    """Runs the captures through the driver pipeline, returning (packets, decode seconds, bytes per packet)."""
+    # Later passes are shifted past the first one so they are not dropped as duplicates
+    timestamps = [data['dateutc'] for line in lines for mac, data in decode(line, 0)]
+    span_ms = max(timestamps) - min(timestamps) + 60000
+    packets = 0
+    decode_time = 0.0
+    allocated = 0
+    for iteration in range(repeat):
+        for line in lines:
+            if measure_memory:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            readings = decode(line, span_ms * iteration)
+            decode_time += time.perf_counter() - start
+            with driver.stats.timer('station_search'):
+                selected = driver.select_stations(readings)
+            observations = driver.new_observations(selected)
+            for _packet in driver.gen_packets(driver.merge_packets(driver.build_packets(observations))):
+                packets += 1
+            if measure_memory:
+                allocated += tracemalloc.get_traced_memory()[1] - before
+    return packets, decode_time, allocated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay Ambient API captures through the driver.')
+    parser.add_argument('captures', nargs='?', default=DEFAULT_CAPTURES, help='JSON lines capture file')
+    parser.add_argument('--repeat', type=int, default=200, help='passes over the captures (default 200)')
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=VALUE',
+                        help='driver option, as in the [ambientweatherapi] section of weewx.conf')
+    args = parser.parse_args()
+
+    lines = load_captures(args.captures)
+    workdir = tempfile.mkdtemp(prefix='awreplay')
+    try:
+        stn_dict = {'api_key': 'replay', 'api_app_key': 'replay',
+                    'state_file': os.path.join(workdir, 'state.json'),
+                    'queue_file': os.path.join(workdir, 'queue.jsonl')}
+        stn_dict.update(option.split('=', 1) for option in args.option)
+
+        driver = AmbientWeatherAPI(**stn_dict)
+        start = time.perf_counter()
+        packets, decode_time, _ = replay(driver, lines, args.repeat)
+        elapsed = time.perf_counter() - start
+
+        print('%d captures x %d passes: %d packets in %.3f s, %.0f packets/sec' %
+              (len(lines), args.repeat, packets, elapsed, packets / elapsed if elapsed else 0))
+        stages = driver.stats.snapshot()['stages']
+        print('%-16s %10s %12s' % ('stage', 'calls', 'us/packet'))
+        print('%-16s %10d %12.2f' % ('decode', len(lines) * args.repeat, decode_time / packets * 1e6))
+        for stage, stats in sorted(stages.items()):
+            print('%-16s %10d %12.2f' % (stage, stats['count'], stats['sum'] / packets * 1e6))
+
+        # A separate, shorter run under tracemalloc, which slows everything down
+        driver = AmbientWeatherAPI(**stn_dict)
+        tracemalloc.start()
+        packets, _, allocated = replay(driver, lines, max(1, args.repeat // 10), measure_memory=True)
+        tracemalloc.stop()
+        print('peak allocation: %.0f bytes/packet' % (allocated / packets if packets else 0))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+""" Check of the unit_system conversion, for every station of a packet.
+
+    Builds the loop packets of two stations sending the same observation, with
+    unit_system set to each of METRIC and METRICWX, and checks that:
+
+      - the first station's mapped fields match the US build put through
+        weewx's own to_std_system(), as StdConvert would have made them (the
+        derived observations use weewx's metric formulas, which differ a
+        little from the US ones, as they would in StdWXCalculate);
+      - every prefixed field of the second station, derived observations
+        included, has the same value as the first station's field, so no field
+        is left in US units under a metric usUnits.
+
+    Exits with status 1 if a check fails.  Run from the repository root with
+    weewx installed:
+
+        python tools/units_check.py
+
+"""
+
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import weewx.units  # noqa: E402
+
+from bench_packet_build import SAMPLE  # noqa: E402
+from user.ambientweatherapi import DERIVED_FIELDS, AmbientWeatherAPI  # noqa: E402
+
+MACS = ('00:0E:C6:00:00:01', '00:0E:C6:00:00:02')
+PREFIX = 'station2_'
+
+
+def same(a, b):
+    """Tells if two packet values are equal, allowing for rounding."""
+    if a is None or b is None:
+        return a is b
+    return math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-9)
+
+
+def build(workdir, unit_system):
+    """Returns the packets of both stations for one warm, windy observation sent twice, a minute apart."""
+    # The second station gets the default prefix, PREFIX
+    driver = AmbientWeatherAPI(api_key='check', api_app_key='check', station_mac=', '.join(MACS),
+                               packet_filter='none', unit_system=unit_system,
+                               latitude='40.0', longitude='-75.0', altitude='100',
+                               state_file=os.path.join(workdir, unit_system + '_state.json'),
+                               queue_file=os.path.join(workdir, unit_system + '_queue.jsonl'))
+    packets = []
+    for minute in range(2):
+        data = dict(SAMPLE, tempf=95.0, humidity=60, windspeedmph=10.0, windgustmph=14.0)
+        data['dateutc'] = SAMPLE['dateutc'] + minute * 60000
+        observations = [(station, mac, dict(data)) for station, mac in zip(driver.stations, MACS)]
+        packets = [packet for mac, data, packet in driver.build_packets(observations)]
+    driver.closePort()
+    return packets
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    failed = 0
+    workdir = tempfile.mkdtemp(prefix='awunits')
+    try:
+        us_first, _ = build(workdir, 'us')
+        for name in ('METRIC', 'METRICWX'):
+            first, second = build(workdir, name.lower())
+            expected = weewx.units.to_std_system(us_first, weewx.units.unit_constants[name])
+            mapped = [key for key in first if key not in DERIVED_FIELDS]
+            wrong = [key for key in mapped if key not in expected or not same(first[key], expected[key])]
+            fields = [key for key in first if key not in ('dateTime', 'usUnits')]
+            unconverted = [key for key in fields if not same(first[key], second.get(PREFIX + key))]
+            for key in wrong:
+                print('FAILED: %s %s is %s, StdConvert gives %s' % (name, key, first[key], expected.get(key)))
+            for key in unconverted:
+                print('FAILED: %s %s%s is %s, the first station has %s' %
+                      (name, PREFIX, key, second.get(PREFIX + key), first[key]))
+            failed += len(wrong) + len(unconverted)
+            print('%s: heatindex %.2f, %sheatindex %.2f, %d fields checked per station' %
+                  (name, first['heatindex'], PREFIX, second[PREFIX + 'heatindex'], len(first)))
+    finally:
+        shutil.rmtree(workdir)
+
+    if failed:
+        print('FAILED: %d field(s)' % failed)
+        sys.exit(1)
+    print('all checks passed')
+
+
+if __name__ == '__main__':
+    main()